@@ -0,0 +1,67 @@
+from typing import Union
+from array import array
+from dump import key_hash
+import sys
+
+
+class PageTable:
+    """
+    Page counts indexed by edition ID. Edition IDs are dense, so this is a
+    flat uint64 array (8 bytes per edition, lengths are bigint) instead of a
+    dict.
+    """
+
+    def __init__(self):
+        self.pages = array("Q")
+
+    def __setitem__(self, id: int, pages: int):
+        if id >= len(self.pages):
+            self.pages.extend([0] * (id + 1 - len(self.pages)))
+        self.pages[id] = pages
+
+    def __getitem__(self, id: int) -> int:
+        return self.pages[id]
+
+    def __len__(self) -> int:
+        return len(self.pages)
+
+    def nbytes(self) -> int:
+        return sys.getsizeof(self.pages)
+
+
+class KeyMap:
+    """
+    String -> ID map keyed by a 64-bit hash of the string, so the strings
+    themselves aren't kept alive.
+    """
+
+    def __init__(self):
+        self.ids: dict[int, int] = {}
+
+    def get(self, key: str) -> Union[int, None]:
+        return self.ids.get(key_hash(key.encode("utf-8")))
+
+    def __setitem__(self, key: str, id: int):
+        self.ids[key_hash(key.encode("utf-8"))] = id
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def nbytes(self) -> int:
+        return sys.getsizeof(self.ids) + sum(
+            [sys.getsizeof(k) + sys.getsizeof(v) for k, v in self.ids.items()]
+        )
+
+
+class Atomics:
+    def __init__(self):
+        self.genre = KeyMap()
+        self.publisher = KeyMap()
+        self.pages = PageTable()
+
+    def memory(self) -> dict[str, int]:
+        return {
+            "genre": self.genre.nbytes(),
+            "publisher": self.publisher.nbytes(),
+            "pages": self.pages.nbytes(),
+        }
@@ -0,0 +1,182 @@
+"""
+Writes a synthetic dump in the Open Library format (type, key, revision,
+last modified, JSON), with roughly the record mix and the mess of the real
+one: works and other record types to skip, authors with odd names,
+editions missing required fields, unknown author keys and free-form
+publish_date values. The output is compressed if the path ends in .gz,
+.bz2 or .xz.
+
+    python bench/make_dump.py bench.dump --records 100000 --seed 1
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from argparse import ArgumentParser
+from dump import OPENERS
+import json
+import random
+
+FIRST_NAMES = [
+    "John", "Mary", "Anna", "José", "Zoë", "Jean-Luc", "Søren", "Li", "Aleksandr",
+    "Mary Ann", "J. R. R.", "Chinua", "Ngũgĩ", "Haruki", "O'Brien", "Émile",
+]
+LAST_NAMES = [
+    "Smith", "Jones", "O'Neil", "García Márquez", "Tolkien", "Achebe",
+    "wa Thiong'o", "Murakami", "Kierkegaard", "Dostoyevsky", "Brontë",
+    "Montgomery-Wellington-Smythe", "Zola", "Li", "van der Berg",
+]
+MONONYMS = ["Plato", "Homer", "Anonymous", "Voltaire", "Unknown"]
+WORDS = [
+    "history", "of", "the", "war", "garden", "night", "river", "a", "guide",
+    "to", "modern", "chemistry", "lost", "city", "tales", "children's",
+    "complete", "works", "introduction", "letters", "empire", "sea",
+]
+PUBLISHERS = [
+    "Penguin", "Penguin Books", "PENGUIN", "Tor", "Ace Books", "Random House",
+    "Oxford University Press", "Harper & Row", "s.n.", "Gallimard",
+]
+GENRES = [
+    "Fiction.", "fiction", "Juvenile fiction.", "Science-fiction", "History",
+    "Biography.", "Poetry", "Drama.", "Horror", "Mystery fiction.",
+]
+EDITIONS = ["1st ed.", "2nd ed.", "Rev. ed.", "First edition", "3rd", "Reprint", ""]
+MONTHS = [
+    "January", "February", "March", "April", "May", "June", "July", "August",
+    "September", "October", "November", "December",
+]
+OTHER_TYPES = ["/type/redirect", "/type/subject", "/type/delete", "/type/i18n_page"]
+
+
+def publish_date(rng: random.Random) -> str:
+    year = rng.randint(1800, 2023)
+    month = rng.randint(1, 12)
+    day = rng.randint(1, 28)
+    return rng.choices(
+        [
+            str(year),
+            f"{MONTHS[month - 1]} {year}",
+            f"{MONTHS[month - 1][:3]} {day:02d}, {year}",
+            f"{MONTHS[month - 1]} {day}, {year}",
+            f"{day} {MONTHS[month - 1]} {year}",
+            f"{year}-{month:02d}-{day:02d}",
+            f"{year}-{month:02d}",
+            f"{month}/{day}/{year}",
+            f"c{year}",
+            f"[{year}?]",
+            f"{str(year)[:2]}--",
+            "n.d.",
+            f"{year}s",
+        ],
+        weights=[40, 15, 10, 8, 5, 8, 3, 3, 3, 2, 1, 1, 1],
+    )[0]
+
+
+def author_record(rng: random.Random, number: int) -> dict:
+    if rng.random() < 0.05:
+        name = rng.choice(MONONYMS)
+    else:
+        name = rng.choice(FIRST_NAMES) + " " + rng.choice(LAST_NAMES)
+    record = {
+        "key": f"/authors/OL{number}A",
+        "name": name,
+        "type": {"key": "/type/author"},
+        "revision": rng.randint(1, 10),
+    }
+    if rng.random() < 0.02:
+        del record["name"]
+    if rng.random() < 0.3:
+        record["birth_date"] = str(rng.randint(1700, 2000))
+    return record
+
+
+def edition_record(rng: random.Random, number: int, authors: int) -> dict:
+    # Half of the links go to a few prolific authors, the rest are spread
+    # out; about 1 in 10 keys never appears as an author record
+    known = authors * 11 // 10
+    author_keys = [
+        "/authors/OL{n}A".format(
+            n=min(int(rng.expovariate(8 / authors)), known)
+            if rng.random() < 0.5
+            else rng.randint(0, known)
+        )
+        for _ in range(rng.choices([0, 1, 2, 3], weights=[5, 80, 12, 3])[0])
+    ]
+    record = {
+        "key": f"/books/OL{number}M",
+        "title": " ".join(rng.choices(WORDS, k=rng.randint(1, 7))).capitalize(),
+        "number_of_pages": rng.choices(
+            [0, rng.randint(1, 40), rng.randint(40, 1200)], weights=[3, 10, 87]
+        )[0],
+        "publish_date": publish_date(rng),
+        "authors": [{"key": key} for key in author_keys],
+        "isbn_13": [str(rng.randint(9780000000000, 9799999999999))],
+        "edition_name": rng.choice(EDITIONS),
+        "publishers": rng.sample(PUBLISHERS, rng.randint(0, 2)),
+        "genres": rng.sample(GENRES, rng.randint(0, 3)),
+        "type": {"key": "/type/edition"},
+        "works": [{"key": f"/works/OL{number}W"}],
+        "revision": rng.randint(1, 10),
+    }
+    roll = rng.random()
+    if roll < 0.25:
+        del record["edition_name"]
+    elif roll < 0.35:
+        del record["number_of_pages"]
+    elif roll < 0.45:
+        record["isbn_13"] = []
+    elif roll < 0.48:
+        record["isbn_13"] = ["978-" + record["isbn_13"][0][3:]]
+    elif roll < 0.5:
+        del record["publish_date"]
+    return record
+
+
+def main():
+    parser = ArgumentParser(description="Write a synthetic Open Library dump")
+    parser.add_argument("path")
+    parser.add_argument("--records", type=int, default=100000, help="Total records")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    authors = max(1, args.records * 15 // 100)
+    opener = OPENERS.get(os.path.splitext(args.path)[1], open)
+    author_number = 0
+    with opener(args.path, "wt", encoding="utf-8") as output:
+        for number in range(args.records):
+            record_type = rng.choices(
+                ["/type/edition", "/type/work", "/type/author", "other"],
+                weights=[50, 30, 15, 5],
+            )[0]
+            if record_type == "/type/author" and author_number < authors:
+                record = author_record(rng, author_number)
+                author_number += 1
+            elif record_type == "/type/edition":
+                record = edition_record(rng, number, authors)
+            elif record_type == "/type/work":
+                record = {
+                    "key": f"/works/OL{number}W",
+                    "title": " ".join(rng.choices(WORDS, k=3)),
+                    "type": {"key": "/type/work"},
+                }
+            else:
+                record_type = rng.choice(OTHER_TYPES)
+                record = {"key": f"/misc/OL{number}X", "type": {"key": record_type}}
+            output.write(
+                "{type}\t{key}\t{revision}\t{modified}\t{data}\n".format(
+                    type=record_type,
+                    key=record["key"],
+                    revision=record.get("revision", 1),
+                    modified="2023-0{m}-1{d}T12:00:00.000000".format(
+                        m=rng.randint(1, 9), d=rng.randint(0, 9)
+                    ),
+                    data=json.dumps(record, ensure_ascii=rng.random() < 0.5),
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
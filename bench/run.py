@@ -0,0 +1,284 @@
+"""
+Runs main.py on a synthetic dump and reports rows/s, wall time and peak
+memory per step, taken from the run's metrics report. The target is either
+a throwaway PostgreSQL cluster (initdb + pg_ctl, unix socket only, deleted
+afterwards) or the file sink. Results are appended to bench/results.jsonl
+with the current commit, and compared against the last result for the same
+settings on this machine from a different commit.
+
+    python bench/run.py --records 200000 --target postgres --runs 3
+    python bench/run.py --target files --set DATA_WORKERS=4 --set JSON_DECODER=msgspec
+
+Options not set by the harness (or --set) still come from the environment
+and a .env file, if there is one.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from typing import Any, Union
+from argparse import ArgumentParser
+from rich import print
+from rich.table import Table
+import json
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH = os.path.join(ROOT, "bench")
+DEFAULT_STEPS = "tables download_books link_books make_users supplemental"
+
+
+def find_binary(name: str, pg_bin: Union[str, None]) -> str:
+    path = shutil.which(name, path=pg_bin) if pg_bin else shutil.which(name)
+    if not path:
+        raise FileNotFoundError(
+            name + " not found, put the PostgreSQL binaries on PATH or pass --pg-bin"
+        )
+    return path
+
+
+class LocalPostgres:
+    """Throwaway cluster in `path`, reachable only through a unix socket."""
+
+    def __init__(self, path: str, pg_bin: Union[str, None]):
+        self.data = os.path.join(path, "pgdata")
+        self.socket = os.path.join(path, "socket")
+        self.pg_ctl = find_binary("pg_ctl", pg_bin)
+        os.makedirs(self.socket, exist_ok=True)
+        subprocess.run(
+            [find_binary("initdb", pg_bin), "-D", self.data, "-U", "bench", "-A", "trust", "--no-sync"],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        subprocess.run(
+            [
+                self.pg_ctl, "-D", self.data, "-l", os.path.join(path, "postgres.log"), "-w",
+                "-o", "-c listen_addresses='' -k {socket} -p 5432".format(socket=self.socket),
+                "start",
+            ],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+
+    def env(self) -> dict[str, str]:
+        return {
+            "DB_IP": self.socket,
+            "DB_PORT": "5432",
+            "DB_USER": "bench",
+            "DB_PASSWORD": "",
+            "DB_DATABASE": "postgres",
+            "DB_TUNNEL": "false",
+        }
+
+    def stop(self):
+        subprocess.run(
+            [self.pg_ctl, "-D", self.data, "-m", "fast", "-w", "stop"],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+
+
+def make_dump(records: int, seed: int) -> str:
+    cache = os.path.join(BENCH, ".cache")
+    os.makedirs(cache, exist_ok=True)
+    path = os.path.join(cache, "dump-{records}-{seed}.txt".format(records=records, seed=seed))
+    if not os.path.exists(path):
+        print("[green]Generating {records} record dump...[/green]".format(records=records))
+        subprocess.run(
+            [sys.executable, os.path.join(BENCH, "make_dump.py"), path + ".tmp",
+             "--records", str(records), "--seed", str(seed)],
+            check=True,
+        )
+        os.replace(path + ".tmp", path)
+    return path
+
+
+def git_commit() -> dict[str, Any]:
+    def git(*args: str) -> str:
+        return subprocess.run(
+            ["git", *args], cwd=ROOT, capture_output=True, text=True
+        ).stdout.strip()
+
+    return {"commit": git("rev-parse", "HEAD"), "dirty": git("status", "--porcelain", "--untracked-files=no") != ""}
+
+
+def run_once(env: dict[str, str], workdir: str, index: int) -> dict[str, Any]:
+    metrics_path = env["METRICS_PATH"]
+    if os.path.exists(metrics_path):
+        os.remove(metrics_path)
+    if os.path.exists(env["SINK_PATH"]):
+        shutil.rmtree(env["SINK_PATH"])
+    log_path = os.path.join(workdir, "run-{index}.log".format(index=index))
+    with open(log_path, "w") as log:
+        result = subprocess.run(
+            [sys.executable, os.path.join(ROOT, "main.py")],
+            cwd=workdir,
+            env=env,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+    if result.returncode != 0:
+        raise RuntimeError("Run {index} failed, see {log}".format(index=index, log=log_path))
+    with open(metrics_path, "r") as report:
+        return json.loads(report.readlines()[-1])
+
+
+def step_summary(runs: list[dict[str, Any]]) -> dict[str, dict[str, float]]:
+    # Median over runs, so one noisy run doesn't decide the result
+    steps = {}
+    for name in runs[0]["steps"].keys():
+        steps[name] = {
+            key: statistics.median([run["steps"][name][key] for run in runs])
+            for key in ["wall_s", "cpu_s", "rows", "rows_per_s", "peak_rss_kb"]
+        }
+    steps["total"] = {
+        "wall_s": statistics.median([run["wall_s"] for run in runs]),
+        "cpu_s": statistics.median([run["cpu_s"] for run in runs]),
+        "rows": statistics.median([run["rows"] for run in runs]),
+        "rows_per_s": statistics.median([run["rows_per_s"] for run in runs]),
+        "peak_rss_kb": statistics.median([run["peak_rss_kb"] for run in runs]),
+    }
+    return steps
+
+
+def previous_result(output: str, result: dict[str, Any]) -> Union[dict[str, Any], None]:
+    if not os.path.exists(output):
+        return None
+    match = None
+    with open(output, "r") as results:
+        for line in results:
+            candidate = json.loads(line)
+            if (
+                candidate["settings"] == result["settings"]
+                and candidate["machine"] == result["machine"]
+                and candidate["commit"] != result["commit"]
+            ):
+                match = candidate
+    return match
+
+
+def change(current: float, previous: Union[float, None]) -> str:
+    if not previous:
+        return ""
+    delta = (current - previous) / previous * 100
+    color = "green" if delta >= 0 else "red"
+    return " [{color}]({delta:+.1f}%)[/{color}]".format(color=color, delta=delta)
+
+
+def print_result(result: dict[str, Any], previous: Union[dict[str, Any], None]):
+    table = Table(title="{target}, {records} records, {runs} run(s)".format(
+        target=result["settings"]["target"],
+        records=result["settings"]["records"],
+        runs=len(result["runs"]),
+    ))
+    for column in ["Step", "Wall (s)", "CPU (s)", "Rows", "Rows/s", "Peak RSS (MB)"]:
+        table.add_column(column, justify="left" if column == "Step" else "right")
+    for name, step in result["steps"].items():
+        before = previous["steps"].get(name) if previous else None
+        table.add_row(
+            name,
+            "{:.2f}".format(step["wall_s"]),
+            "{:.2f}".format(step["cpu_s"]),
+            str(int(step["rows"])),
+            "{:.0f}".format(step["rows_per_s"]) + change(step["rows_per_s"], before["rows_per_s"] if before else None),
+            "{:.1f}".format(step["peak_rss_kb"] / 1024),
+        )
+    print(table)
+    if previous:
+        print("[grey70 italic]Compared with {commit} from {started}[/grey70 italic]".format(
+            commit=previous["commit"][:10], started=previous["runs"][0]["started"]
+        ))
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark datagen steps")
+    parser.add_argument("--records", type=int, default=100000, help="Records in the synthetic dump")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the dump and DATA_SEED")
+    parser.add_argument("--target", choices=["postgres", "files"], default="files")
+    parser.add_argument("--steps", default=DEFAULT_STEPS)
+    parser.add_argument("--runs", type=int, default=1)
+    parser.add_argument("--pg-bin", default=None, help="Directory with initdb and pg_ctl")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="Extra option for main.py")
+    parser.add_argument("--output", default=os.path.join(BENCH, "results.jsonl"))
+    parser.add_argument("--keep", action="store_true", help="Keep the work directory")
+    args = parser.parse_args()
+
+    dump = make_dump(args.records, args.seed)
+    workdir = tempfile.mkdtemp(prefix="datagen-bench-")
+    overrides = dict([option.split("=", 1) for option in args.set])
+
+    env = os.environ.copy()
+    env.update(
+        {
+            "DB_IP": "unused",
+            "DB_USER": "unused",
+            "DB_PASSWORD": "unused",
+            "DB_DATABASE": "unused",
+            "DB_TABLES": os.path.join(ROOT, "spec", "tables.json"),
+            "DB_CLEAR": "true",
+            "STEPS": args.steps,
+            "DATA_PATH": dump,
+            "DATA_LIMIT": "",
+            "DATA_SEED": str(args.seed),
+            "NAMES_DICT": os.path.join(ROOT, "spec", "names.dic"),
+            "WORDS_DICT": os.path.join(ROOT, "spec", "words.dic"),
+            "AUDIENCES": "young adult, adult, children, education, government, reference",
+            "START_DELTA": "31536000",
+            "END_DELTA": "31536000",
+            "GENERATE": "250",
+            "CHECKPOINT_PATH": "",
+            "RESUME": "false",
+            "METRICS_PATH": os.path.join(workdir, "metrics.jsonl"),
+            "SINK": "files" if args.target == "files" else "db",
+            "SINK_PATH": os.path.join(workdir, "output"),
+        }
+    )
+
+    postgres = None
+    try:
+        if args.target == "postgres":
+            postgres = LocalPostgres(workdir, args.pg_bin)
+            env.update(postgres.env())
+        env.update(overrides)
+
+        runs = []
+        for index in range(args.runs):
+            print("[green]Run {n} of {total}...[/green]".format(n=index + 1, total=args.runs))
+            runs.append(run_once(env, workdir, index))
+    finally:
+        if postgres:
+            postgres.stop()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    result = {
+        **git_commit(),
+        "machine": {
+            "node": platform.node(),
+            "processor": platform.processor(),
+            "cpus": os.cpu_count(),
+            "python": platform.python_version(),
+        },
+        "settings": {
+            "records": args.records,
+            "seed": args.seed,
+            "target": args.target,
+            "steps": args.steps,
+            "overrides": overrides,
+        },
+        "steps": step_summary(runs),
+        "runs": runs,
+    }
+    print_result(result, previous_result(args.output, result))
+    with open(args.output, "a") as results:
+        results.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+from typing import Any
+import os
+import pickle
+import random
+import time
+
+
+class Checkpoint:
+    """
+    Periodically persists generator state (ID counters, atomics, RNG state,
+    completed steps and in-step positions) so a run can be resumed.
+    State is only written right after the row cache has been flushed.
+    """
+
+    def __init__(self, context, path: str, interval: int, resume: bool):
+        self.context = context
+        self.path = path
+        self.interval = interval
+        self.last = time.time()
+        self.resumed = False
+        self.steps: list[str] = []
+        self.positions: dict[str, Any] = {}
+
+        if resume and path and os.path.exists(path):
+            with open(path, "rb") as state_file:
+                state = pickle.load(state_file)
+            self.steps = state["steps"]
+            self.positions = state["positions"]
+            context.ids = state["ids"]
+            context.atomics = state["atomics"]
+            context.resolver = state["resolver"]
+            random.setstate(state["random"])
+            self.resumed = True
+
+    def done(self, step: str) -> bool:
+        return step in self.steps
+
+    def position(self, step: str, default: Any = None) -> Any:
+        return self.positions.get(step, default)
+
+    def tick(self, step: str, position: Any):
+        if self.path and time.time() - self.last >= self.interval:
+            self.save(step, position)
+
+    def save(self, step: str, position: Any):
+        self.positions[step] = position
+        self._write()
+
+    def complete(self, step: str):
+        if not step in self.steps:
+            self.steps.append(step)
+        if step in self.positions.keys():
+            del self.positions[step]
+        self._write()
+
+    def _write(self):
+        if not self.path:
+            return
+        self.context.clean_cache()
+        with open(self.path + ".tmp", "wb") as state_file:
+            pickle.dump(
+                {
+                    "steps": self.steps,
+                    "positions": self.positions,
+                    "ids": self.context.ids,
+                    "atomics": self.context.atomics,
+                    "resolver": self.context.resolver,
+                    "random": random.getstate(),
+                },
+                state_file,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        os.replace(self.path + ".tmp", self.path)
+        self.last = time.time()
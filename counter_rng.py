@@ -0,0 +1,44 @@
+"""
+Counter-based random numbers: every value is a hash of (stream, entity,
+counter), so it doesn't depend on what was drawn before it, or in which
+process. Streams are keyed by seed, table and purpose.
+"""
+
+import hashlib
+import numpy as np
+
+GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+
+
+def stream(seed: int, table: str, purpose: str) -> np.uint64:
+    key = "{seed}/{table}/{purpose}".format(seed=seed, table=table, purpose=purpose)
+    return np.uint64(
+        int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little")
+    )
+
+
+def mix(x):
+    # splitmix64 finalizer, uint64 arithmetic wraps
+    x = x + GOLDEN
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def bits(key: np.uint64, entity, counter):
+    # At least 1-d, numpy warns on scalar overflow but not on arrays
+    entity = np.atleast_1d(entity).astype(np.uint64)
+    counter = np.atleast_1d(counter).astype(np.uint64)
+    return mix(mix(key ^ entity) ^ counter)
+
+
+def uniform(key: np.uint64, entity, counter):
+    # [0, 1) with 53 bits of precision
+    return (bits(key, entity, counter) >> np.uint64(11)).astype(np.float64) * (2.0 ** -53)
+
+
+def integers(key: np.uint64, entity, counter, low, high):
+    # [low, high], either bound may be an array
+    low = np.asarray(low, dtype=np.int64)
+    span = np.asarray(high, dtype=np.int64) - low + 1
+    return low + (uniform(key, entity, counter) * span).astype(np.int64)
@@ -0,0 +1,123 @@
+from functools import lru_cache
+from typing import Union
+import calendar
+import datetime
+import dateutil.parser
+import re
+
+MONTHS = {
+    "jan": 1,
+    "january": 1,
+    "feb": 2,
+    "february": 2,
+    "mar": 3,
+    "march": 3,
+    "apr": 4,
+    "april": 4,
+    "may": 5,
+    "jun": 6,
+    "june": 6,
+    "jul": 7,
+    "july": 7,
+    "aug": 8,
+    "august": 8,
+    "sep": 9,
+    "sept": 9,
+    "september": 9,
+    "oct": 10,
+    "october": 10,
+    "nov": 11,
+    "november": 11,
+    "dec": 12,
+    "december": 12,
+}
+
+MONTH = "(" + "|".join(MONTHS.keys()) + r")\.?"
+
+# (pattern, names of the captured groups in order)
+FAST_PATHS = [
+    (re.compile(r"^(\d{4})$"), ("year",)),
+    (re.compile(r"^" + MONTH + r",? (\d{4})$", re.IGNORECASE), ("month", "year")),
+    (
+        re.compile(r"^" + MONTH + r" (\d{1,2}),? (\d{4})$", re.IGNORECASE),
+        ("month", "day", "year"),
+    ),
+    (
+        re.compile(r"^(\d{1,2}) " + MONTH + r",? (\d{4})$", re.IGNORECASE),
+        ("day", "month", "year"),
+    ),
+    (re.compile(r"^(\d{4})-(\d{1,2})-(\d{1,2})$"), ("year", "month", "day")),
+    (re.compile(r"^(\d{4})-(\d{1,2})$"), ("year", "month")),
+    (re.compile(r"^(\d{1,2})/(\d{1,2})/(\d{4})$"), ("month", "day", "year")),
+]
+
+
+class PublishDateParser:
+    """
+    Converts Open Library publish_date strings to timestamps, matching
+    dateutil.parser.parse (missing fields default to today at midnight).
+    Common shapes are handled by regexes, results are kept in an LRU cache.
+    """
+
+    def __init__(self, cache_size: int = 65536):
+        self.default = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        self.fast = 0
+        self.fallback = 0
+        self.failed = 0
+        self._cached = lru_cache(maxsize=cache_size)(self._parse)
+
+    def parse(self, raw: str) -> int:
+        result = self._cached(raw)
+        if result is None:
+            raise ValueError("Unable to parse date string " + raw)
+        return result
+
+    def stats(self) -> dict[str, int]:
+        info = self._cached.cache_info()
+        return {
+            "hits": info.hits,
+            "misses": info.misses,
+            "fast": self.fast,
+            "fallback": self.fallback,
+            "failed": self.failed,
+        }
+
+    def _parse(self, raw: str) -> Union[int, None]:
+        cleaned = raw.replace("?", "").strip()
+        for pattern, fields in FAST_PATHS:
+            match = pattern.match(cleaned)
+            if not match:
+                continue
+            parsed = self._build(dict(zip(fields, match.groups())))
+            if parsed is not None:
+                self.fast += 1
+                return parsed
+            break
+
+        self.fallback += 1
+        try:
+            return int(dateutil.parser.parse(cleaned).timestamp())
+        except SystemExit:
+            exit(0)
+        except:
+            self.failed += 1
+            return None
+
+    def _build(self, fields: dict[str, str]) -> Union[int, None]:
+        year = int(fields["year"])
+        month = fields.get("month", self.default.month)
+        if isinstance(month, str):
+            month = MONTHS[month.lower()] if not month.isdigit() else int(month)
+        if not 1 <= month <= 12 or year < 1:
+            return None
+
+        if "day" in fields.keys():
+            day = int(fields["day"])
+        else:
+            # dateutil clamps the default day to the end of shorter months
+            day = min(self.default.day, calendar.monthrange(year, month)[1])
+
+        try:
+            return int(self.default.replace(year=year, month=month, day=day).timestamp())
+        except (ValueError, OverflowError):
+            return None
@@ -0,0 +1,63 @@
+from typing import Any, Callable
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+Decoder = Callable[[str, str], dict]
+
+
+def make_decoder(
+    name: str, edition_keys: list[str], author_keys: list[str]
+) -> Decoder:
+    if name == "json":
+        return lambda record_type, data: json.loads(data)
+
+    if name == "orjson":
+        if orjson is None:
+            raise ImportError("JSON_DECODER = orjson requires the orjson package")
+        return lambda record_type, data: orjson.loads(data)
+
+    if name == "msgspec":
+        if msgspec is None:
+            raise ImportError("JSON_DECODER = msgspec requires the msgspec package")
+        return SelectiveDecoder(
+            {"/type/edition": edition_keys, "/type/author": author_keys}
+        )
+
+    raise ValueError("Unknown JSON_DECODER: " + name)
+
+
+class SelectiveDecoder:
+    """
+    Decodes only the listed fields of each record type, the rest of the
+    document is validated and skipped without building Python objects.
+    Missing fields are left out of the result, same as with json.loads.
+    """
+
+    def __init__(self, fields: dict[str, list[str]]):
+        self.fields = fields
+        self.decoders = {
+            record_type: msgspec.json.Decoder(
+                msgspec.defstruct(
+                    "Fields",
+                    [(k, Any, msgspec.UNSET) for k in keys],
+                )
+            )
+            for record_type, keys in fields.items()
+        }
+
+    def __call__(self, record_type: str, data: str) -> dict:
+        decoded = self.decoders[record_type].decode(data)
+        return {
+            k: getattr(decoded, k)
+            for k in self.fields[record_type]
+            if getattr(decoded, k) is not msgspec.UNSET
+        }
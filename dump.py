@@ -0,0 +1,176 @@
+from typing import NamedTuple, Iterator, Union, BinaryIO
+from array import array
+from bisect import bisect_left, bisect_right
+from hashlib import blake2b
+from queue import Queue
+from threading import Thread
+import bz2
+import gzip
+import lzma
+import os
+
+RECORD_TYPES = (b"/type/author\t", b"/type/edition\t")
+
+OPENERS = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+
+
+class DumpBlock(NamedTuple):
+    data: bytes
+    offset: int
+    consumed: int
+
+
+def is_compressed(path: str) -> bool:
+    return os.path.splitext(path)[1] in OPENERS.keys()
+
+
+def filter_records(data: bytes) -> bytes:
+    return b"\n".join(
+        [line for line in data.split(b"\n") if line.startswith(RECORD_TYPES)]
+    )
+
+
+class DumpReader:
+    """
+    Reads a plain or compressed dump as blocks of whole, pre-filtered lines.
+    Reading and decompression run on a background thread so they overlap
+    with parsing. Each block carries the offset in the uncompressed stream
+    after it (for checkpoints) and the number of bytes read from disk so far
+    (for progress).
+    """
+
+    def __init__(self, path: str, block_size: int, skip: int = 0, prefetch: int = 8):
+        self.path = path
+        self.block_size = block_size
+        self.skip = skip
+        self.blocks: Queue[Union[DumpBlock, Exception, None]] = Queue(maxsize=prefetch)
+        self.raw: BinaryIO = open(path, "rb")
+        self.stream: BinaryIO = (
+            OPENERS[os.path.splitext(path)[1]](self.raw)
+            if is_compressed(path)
+            else self.raw
+        )
+        self.closed = False
+        self.thread = Thread(target=self._read, daemon=True)
+
+    def __enter__(self) -> "DumpReader":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.closed = True
+        # Unblock the reader thread if it is waiting on a full queue
+        while self.thread.is_alive():
+            while not self.blocks.empty():
+                self.blocks.get_nowait()
+            self.thread.join(0.1)
+        self.stream.close()
+        self.raw.close()
+
+    def __iter__(self) -> Iterator[DumpBlock]:
+        while True:
+            block = self.blocks.get()
+            if block is None:
+                return
+            if isinstance(block, Exception):
+                raise block
+            yield block
+
+    def _read(self):
+        try:
+            offset = self._seek(self.skip)
+            remainder = b""
+            while not self.closed:
+                data = self.stream.read(self.block_size)
+                if len(data) == 0:
+                    if len(remainder) > 0:
+                        offset += len(remainder)
+                        self._put(filter_records(remainder), offset)
+                    break
+
+                data = remainder + data
+                split = data.rfind(b"\n") + 1
+                remainder = data[split:]
+                offset += split
+                self._put(filter_records(data[:split]), offset)
+            self.blocks.put(None)
+        except Exception as e:
+            self.blocks.put(e)
+
+    def _seek(self, skip: int) -> int:
+        if not is_compressed(self.path):
+            self.stream.seek(skip)
+            return skip
+
+        # Compressed streams can't seek, so decompress and discard instead
+        skipped = 0
+        while skipped < skip:
+            data = self.stream.read(min(self.block_size, skip - skipped))
+            if len(data) == 0:
+                break
+            skipped += len(data)
+        return skipped
+
+    def _put(self, data: bytes, offset: int):
+        self.blocks.put(DumpBlock(data, offset, self.raw.tell()))
+
+
+INDEX_MAGIC = b"OLIDX1\n"
+
+
+class DumpIndex(NamedTuple):
+    editions: array
+    author_hashes: array
+    author_offsets: array
+
+
+def key_hash(key: bytes) -> int:
+    return int.from_bytes(blake2b(key, digest_size=8).digest(), "little")
+
+
+class IndexBuilder:
+    """
+    Collects the byte offset of every edition line and a (key hash, offset)
+    pair for every author line of a filtered dump.
+    """
+
+    def __init__(self):
+        self.editions = array("Q")
+        self.authors: list[tuple[int, int]] = []
+
+    def add(self, data: bytes, offset: int):
+        for line in data.split(b"\n"):
+            if line.startswith(RECORD_TYPES[1]):
+                self.editions.append(offset)
+            elif line.startswith(RECORD_TYPES[0]):
+                self.authors.append((key_hash(line.split(b"\t", 2)[1]), offset))
+            offset += len(line) + 1
+
+    def write(self, path: str):
+        self.authors.sort()
+        author_hashes = array("Q", [a[0] for a in self.authors])
+        author_offsets = array("Q", [a[1] for a in self.authors])
+        with open(path, "wb") as index_file:
+            index_file.write(INDEX_MAGIC)
+            for values in [self.editions, author_hashes, author_offsets]:
+                index_file.write(len(values).to_bytes(8, "little"))
+                values.tofile(index_file)
+
+
+def read_index(path: str) -> DumpIndex:
+    with open(path, "rb") as index_file:
+        if index_file.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            raise ValueError("Not a dump index: " + path)
+        arrays = []
+        for _ in range(3):
+            values = array("Q")
+            values.fromfile(index_file, int.from_bytes(index_file.read(8), "little"))
+            arrays.append(values)
+    return DumpIndex(*arrays)
+
+
+def find_author(index: DumpIndex, key: str) -> list[int]:
+    hashed = key_hash(key.encode("utf-8"))
+    start = bisect_left(index.author_hashes, hashed)
+    end = bisect_right(index.author_hashes, hashed, lo=start)
+    return index.author_offsets[start:end].tolist()
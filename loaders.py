@@ -0,0 +1,279 @@
+from dataclasses import dataclass
+from typing import Union
+import psycopg
+import re
+
+INSERT_PATTERN = re.compile(
+    r"^\s*INSERT INTO\s+(\w+)\s*\(([^)]*)\)\s*VALUES\s*\(([^)]*)\)(.*)$",
+    re.IGNORECASE | re.DOTALL,
+)
+
+
+@dataclass
+class Statement:
+    query: str
+    table: str
+    columns: list[str]
+    params: list[str]
+    on_conflict: bool
+    copyable: bool
+
+
+def parse_insert(query: str) -> Statement:
+    match = INSERT_PATTERN.match(query)
+    if not match:
+        raise ValueError("Unsupported cached statement: " + query)
+    table, columns, values, tail = match.groups()
+    columns = [c.strip() for c in columns.split(",")]
+    values = [v.strip() for v in values.split(",")]
+
+    mapped_columns = []
+    params = []
+    placeholders = []
+    copyable = True
+    for column, value in zip(columns, values):
+        if value.startswith(":"):
+            mapped_columns.append(column)
+            params.append(value[1:])
+            placeholders.append("%s")
+        else:
+            # NULL literals can be left out of a COPY, anything else can't
+            if value.upper() != "NULL":
+                copyable = False
+            placeholders.append(value)
+
+    return Statement(
+        query="INSERT INTO {table} ({columns}) VALUES ({values}){tail}".format(
+            table=table,
+            columns=", ".join(columns),
+            values=", ".join(placeholders),
+            tail=tail,
+        ),
+        table=table,
+        columns=mapped_columns,
+        params=params,
+        on_conflict="ON CONFLICT DO NOTHING" in tail.upper(),
+        copyable=copyable,
+    )
+
+
+def column_type(spec: str) -> str:
+    return spec.split(" ")[1].split("(")[0].lower()
+
+
+class FlushError(RuntimeError):
+    pass
+
+
+class InsertLoader:
+    pipelined = True
+
+    def flush(self, db: psycopg.Connection, statement: Statement, rows: list[tuple]):
+        cursor = db.cursor()
+        cursor.executemany(statement.query, rows)
+
+    async def flush_async(
+        self, db: psycopg.AsyncConnection, statement: Statement, rows: list[tuple]
+    ):
+        cursor = db.cursor()
+        await cursor.executemany(statement.query, rows)
+
+
+@dataclass
+class CopyPlan:
+    binary: bool
+    types: list[str]
+    before: list[str]
+    copy: str
+    after: list[str]
+
+
+class CopyLoader:
+    # COPY can't run inside a pipeline
+    pipelined = False
+
+    def __init__(
+        self,
+        types: dict[str, dict[str, str]],
+        binary: bool = True,
+        unkeyed: set[str] = set(),
+    ):
+        self.types = types
+        self.binary = binary
+        # Tables without keys yet (TABLE_PROFILE = load) can't conflict
+        self.unkeyed = unkeyed
+        self.fallback = InsertLoader()
+
+    def plan(self, statement: Statement) -> CopyPlan:
+        table_types = self.types.get(statement.table, {})
+        binary = self.binary and all([c in table_types for c in statement.columns])
+        columns = ", ".join(statement.columns)
+
+        # COPY can't skip conflicting rows, so those go through a temp table first
+        target = statement.table
+        before = []
+        after = []
+        if statement.on_conflict and not statement.table in self.unkeyed:
+            target = "_copy_" + statement.table
+            before.append(
+                "CREATE TEMP TABLE IF NOT EXISTS {stage} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS".format(
+                    stage=target, table=statement.table
+                )
+            )
+            after.append(
+                "INSERT INTO {table} ({columns}) SELECT {columns} FROM {stage} ON CONFLICT DO NOTHING".format(
+                    table=statement.table, columns=columns, stage=target
+                )
+            )
+            after.append("TRUNCATE {stage}".format(stage=target))
+
+        return CopyPlan(
+            binary=binary,
+            types=[table_types[c] for c in statement.columns] if binary else [],
+            before=before,
+            copy="COPY {target} ({columns}) FROM STDIN{format}".format(
+                target=target,
+                columns=columns,
+                format=" (FORMAT BINARY)" if binary else "",
+            ),
+            after=after,
+        )
+
+    def flush(self, db: psycopg.Connection, statement: Statement, rows: list[tuple]):
+        if not statement.copyable:
+            return self.fallback.flush(db, statement, rows)
+
+        plan = self.plan(statement)
+        cursor = db.cursor()
+        for query in plan.before:
+            cursor.execute(query)
+        with cursor.copy(plan.copy) as copy:
+            if plan.binary:
+                copy.set_types(plan.types)
+            for row in rows:
+                copy.write_row(row)
+        for query in plan.after:
+            cursor.execute(query)
+
+    async def flush_async(
+        self, db: psycopg.AsyncConnection, statement: Statement, rows: list[tuple]
+    ):
+        if not statement.copyable:
+            return await self.fallback.flush_async(db, statement, rows)
+
+        plan = self.plan(statement)
+        cursor = db.cursor()
+        for query in plan.before:
+            await cursor.execute(query)
+        async with cursor.copy(plan.copy) as copy:
+            if plan.binary:
+                copy.set_types(plan.types)
+            for row in rows:
+                await copy.write_row(row)
+        for query in plan.after:
+            await cursor.execute(query)
+
+
+def make_loader(
+    mode: str,
+    types: dict[str, dict[str, str]],
+    copy_format: str,
+    unkeyed: set[str] = set(),
+) -> Union[InsertLoader, CopyLoader]:
+    if mode == "insert":
+        return InsertLoader()
+    if mode == "copy":
+        return CopyLoader(types, binary=copy_format == "binary", unkeyed=unkeyed)
+    raise ValueError("Unknown DB_LOADER: " + mode)
+
+
+def describe_batch(batches: list[tuple[Statement, list[tuple]]], index: int) -> str:
+    return "batch {index} of {total} ({count} rows into {table})".format(
+        index=index + 1,
+        total=len(batches),
+        count=len(batches[index][1]),
+        table=batches[index][0].table,
+    )
+
+
+def flush_batches(
+    db: psycopg.Connection,
+    loader: Union[InsertLoader, CopyLoader],
+    batches: list[tuple[Statement, list[tuple]]],
+    pipeline: bool,
+):
+    if not (pipeline and loader.pipelined):
+        for index, (statement, rows) in enumerate(batches):
+            try:
+                loader.flush(db, statement, rows)
+            except psycopg.Error as e:
+                try:
+                    db.rollback()
+                except psycopg.Error:
+                    # The batch failure is the one worth reporting
+                    pass
+                raise FlushError(describe_batch(batches, index) + " failed: " + str(e)) from e
+        db.commit()
+        return
+
+    # All batches are sent before the single sync at commit
+    try:
+        with db.pipeline():
+            for statement, rows in batches:
+                loader.flush(db, statement, rows)
+            db.commit()
+        return
+    except psycopg.Error as e:
+        try:
+            db.rollback()
+        except psycopg.Error:
+            # Nothing left to replay the batches on
+            raise FlushError(
+                "pipeline of {count} batches failed: {error}".format(
+                    count=len(batches), error=e
+                )
+            ) from e
+
+    # The pipeline only reports that something failed, so replay the
+    # batches one by one to find out which one it was
+    flush_batches(db, loader, batches, False)
+
+
+async def flush_batches_async(
+    db: psycopg.AsyncConnection,
+    loader: Union[InsertLoader, CopyLoader],
+    batches: list[tuple[Statement, list[tuple]]],
+    pipeline: bool,
+):
+    if not (pipeline and loader.pipelined):
+        for index, (statement, rows) in enumerate(batches):
+            try:
+                await loader.flush_async(db, statement, rows)
+            except psycopg.Error as e:
+                try:
+                    await db.rollback()
+                except psycopg.Error:
+                    # The batch failure is the one worth reporting
+                    pass
+                raise FlushError(describe_batch(batches, index) + " failed: " + str(e)) from e
+        await db.commit()
+        return
+
+    try:
+        async with db.pipeline():
+            for statement, rows in batches:
+                await loader.flush_async(db, statement, rows)
+            await db.commit()
+        return
+    except psycopg.Error as e:
+        try:
+            await db.rollback()
+        except psycopg.Error:
+            # Nothing left to replay the batches on
+            raise FlushError(
+                "pipeline of {count} batches failed: {error}".format(
+                    count=len(batches), error=e
+                )
+            ) from e
+
+    await flush_batches_async(db, loader, batches, False)
@@ -1,26 +1,43 @@
-from util import GeneratorContext
-from steps.tables import tables_main
+from dotenv import load_dotenv
+from os import getenv
+from util import GeneratorContext, AsyncGeneratorContext
+from steps.tables import tables_main, finalize_tables
 from steps.download_books import download_books_main
 from steps.link_books import link_books_main
 from steps.make_users import make_users_main
 from steps.supplemental import supplemental_main
+import asyncio
 
-def main():
-    context = GeneratorContext()
-    tables_main(context)
-    if "download_books" in context.options["steps"]:
-        download_books_main(context)
+def run_steps(context: GeneratorContext):
+    with context.metrics.step("tables"):
+        tables_main(context)
+    for step, step_main in [
+        ("download_books", download_books_main),
+        ("link_books", link_books_main),
+        ("make_users", make_users_main),
+        ("supplemental", supplemental_main),
+    ]:
+        if step in context.options["steps"] and not context.checkpoint.done(step):
+            with context.metrics.step(step):
+                step_main(context)
+            context.checkpoint.complete(step)
 
-    if "link_books" in context.options["steps"]:
-        link_books_main(context)
+    with context.metrics.step("finalize_tables"):
+        finalize_tables(context)
+    context.cleanup()
 
-    if "make_users" in context.options["steps"]:
-        make_users_main(context)
-    
-    if "supplemental" in context.options["steps"]:
-        supplemental_main(context)
+async def async_main():
+    # Steps run in a worker thread while the loop flushes their batches
+    loop = asyncio.get_running_loop()
+    context = await asyncio.to_thread(AsyncGeneratorContext, loop)
+    await asyncio.to_thread(run_steps, context)
 
-    context.cleanup()
+def main():
+    load_dotenv()
+    if getenv("DB_ASYNC", "false") == "true":
+        asyncio.run(async_main())
+    else:
+        run_steps(GeneratorContext())
 
 if __name__ == "__main__":
     main()
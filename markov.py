@@ -0,0 +1,201 @@
+from typing import Union
+from collections import defaultdict
+from markov_word_generator import MarkovWordGenerator, DELIMITER_END
+import hashlib
+import os
+import pickle
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Batch size BatchMarkov.generate_word() refills its buffer with
+WORD_BUFFER = 4096
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as dictionary:
+        for block in iter(lambda: dictionary.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+class MarkovCache:
+    """
+    Trained MarkovWordGenerators keyed by dictionary path, content hash and
+    chain length. Models are shared within the process and their transition
+    counts are pickled to `path` (a directory), so later runs skip training.
+    An empty `path` keeps models in memory only.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.models: dict[tuple[str, str, int], MarkovWordGenerator] = {}
+        self.tables: dict[int, MarkovTables] = {}
+
+    def get(self, dictionary: str, length: int) -> MarkovWordGenerator:
+        dictionary = os.path.abspath(dictionary)
+        key = (dictionary, file_digest(dictionary), length)
+        if not key in self.models.keys():
+            model = self._load(key)
+            if not model:
+                model = MarkovWordGenerator(
+                    markov_length=length, dictionary_filename=dictionary
+                )
+                self._save(key, model)
+            self.models[key] = model
+        return self.models[key]
+
+    def batch(self, dictionary: str, length: int, seed: int) -> "BatchMarkov":
+        model = self.get(dictionary, length)
+        if not id(model) in self.tables.keys():
+            self.tables[id(model)] = MarkovTables(model.mapping_chars, length)
+        return BatchMarkov(self.tables[id(model)], seed)
+
+    def _file(self, key: tuple[str, str, int]) -> str:
+        dictionary, digest, length = key
+        return os.path.join(
+            self.path,
+            "{name}.{length}.{digest}.markov".format(
+                name=os.path.basename(dictionary), length=length, digest=digest
+            ),
+        )
+
+    def _load(self, key: tuple[str, str, int]):
+        if not self.path or not os.path.exists(self._file(key)):
+            return None
+        try:
+            with open(self._file(key), "rb") as model_file:
+                counts = pickle.load(model_file)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        # Skips __post_init__, which would retrain from the dictionary
+        model = object.__new__(MarkovWordGenerator)
+        model.markov_length = key[2]
+        model.language = None
+        model.word_type = None
+        model.dictionary_filename = key[0]
+        model.ignore_accents = False
+        model.mapping_chars = defaultdict(int, counts)
+        return model
+
+    def _save(self, key: tuple[str, str, int], model: MarkovWordGenerator):
+        if not self.path:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        path = self._file(key)
+        with open(path + ".tmp", "wb") as model_file:
+            pickle.dump(
+                dict(model.mapping_chars), model_file, protocol=pickle.HIGHEST_PROTOCOL
+            )
+        os.replace(path + ".tmp", path)
+
+
+class MarkovTables:
+    """
+    A trained chain as arrays. Each context (the last `length` characters)
+    is a row of outgoing edges; `keys` holds row + cumulative probability
+    for every edge, so one searchsorted picks the next edge of many words
+    at once. Edges that end the word have char 0 and next state -1.
+    """
+
+    def __init__(self, counts: dict[str, int], length: int):
+        if np is None:
+            raise ImportError("MARKOV_ENGINE = numpy requires the numpy package")
+        self.length = length
+        starts: dict[str, int] = {}
+        edges: dict[str, dict[str, int]] = defaultdict(dict)
+        for gram, count in counts.items():
+            if count <= 0:
+                continue
+            if gram[0] == "^":
+                starts[gram[1:]] = count
+            else:
+                edges[gram[:length]][gram[length]] = count
+
+        contexts = {context: row for row, context in enumerate(edges.keys())}
+
+        self.start_cdf = self._cdf(list(starts.values()))
+        self.start_chars = np.zeros((len(starts), length), dtype=np.uint32)
+        self.start_state = np.full(len(starts), -1, dtype=np.int64)
+        for i, token in enumerate(starts.keys()):
+            if token.endswith(DELIMITER_END):
+                token = token[:-1]
+            else:
+                self.start_state[i] = contexts.get(token, -1)
+            self.start_chars[i, : len(token)] = [ord(c) for c in token]
+
+        keys = []
+        self.edge_char = []
+        self.edge_next = []
+        for context, row in contexts.items():
+            keys.append(row + self._cdf(list(edges[context].values())))
+            for char in edges[context].keys():
+                if char == DELIMITER_END:
+                    self.edge_char.append(0)
+                    self.edge_next.append(-1)
+                else:
+                    self.edge_char.append(ord(char))
+                    self.edge_next.append(contexts.get(context[1:] + char, -1))
+        self.keys = np.concatenate(keys) if keys else np.zeros(0)
+        self.edge_char = np.array(self.edge_char, dtype=np.uint32)
+        self.edge_next = np.array(self.edge_next, dtype=np.int64)
+
+    @staticmethod
+    def _cdf(counts: list[int]):
+        cdf = np.cumsum(np.array(counts, dtype=np.float64))
+        cdf /= cdf[-1]
+        cdf[-1] = 1.0
+        return cdf
+
+
+class BatchMarkov:
+    """
+    Samples words from MarkovTables with its own seeded RNG, with the same
+    distribution as MarkovWordGenerator.generate_word().
+    """
+
+    def __init__(self, tables: MarkovTables, seed: int):
+        self.tables = tables
+        self.rng = np.random.default_rng(seed)
+        self.buffer: list[str] = []
+
+    def generate(self, count: int, limit: Union[int, None] = None) -> list[str]:
+        """Generates `count` words, cut to `limit` characters."""
+        tables = self.tables
+        start = np.searchsorted(tables.start_cdf, self.rng.random(count), side="right")
+        columns = [tables.start_chars[start]]
+        width = tables.length
+        state = tables.start_state[start]
+        active = np.flatnonzero(state >= 0)
+        while len(active) > 0 and (limit is None or width < limit):
+            edge = np.searchsorted(
+                tables.keys, state[active] + self.rng.random(len(active)), side="right"
+            )
+            column = np.zeros((count, 1), dtype=np.uint32)
+            column[active, 0] = tables.edge_char[edge]
+            state[active] = tables.edge_next[edge]
+            columns.append(column)
+            width += 1
+            active = active[state[active] >= 0]
+
+        chars = np.ascontiguousarray(np.hstack(columns)[:, :limit])
+        # Code points padded with zeros read as fixed-width strings
+        return chars.view("<U" + str(chars.shape[1]))[:, 0].tolist()
+
+    def generate_word(self) -> str:
+        if len(self.buffer) == 0:
+            self.buffer = self.generate(WORD_BUFFER)
+        return self.buffer.pop()
+
+
+def generate_words(
+    markov: Union[MarkovWordGenerator, BatchMarkov],
+    count: int,
+    limit: Union[int, None] = None,
+) -> list[str]:
+    if isinstance(markov, BatchMarkov):
+        return markov.generate(count, limit)
+    return [markov.generate_word()[:limit] for _ in range(count)]
@@ -0,0 +1,147 @@
+from typing import Any, Iterator
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from threading import Lock
+from loaders import Statement
+import json
+import os
+import resource
+import time
+
+
+def cpu_time() -> float:
+    # Includes the writer threads and, once they've exited, parse workers
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def peak_rss() -> int:
+    # kB, since the last reset_peak_rss() where supported
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def reset_peak_rss():
+    # Linux only, lets each step report its own peak. Elsewhere steps report
+    # the peak of the run so far.
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
+
+
+def percentile(values: list[float], p: float) -> float:
+    if len(values) == 0:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+class Metrics:
+    """
+    Collects timings and row counts for a run. Flushes are recorded by the
+    writers (possibly from their own threads), steps by main. report()
+    appends one JSON object per run to `path`.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.started = datetime.now()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = cpu_time()
+        self.lock = Lock()
+        self.steps: dict[str, dict[str, float]] = {}
+        self.rows: Counter = Counter()
+        self.latencies: list[float] = []
+        self.waited = 0.0
+        self.dump_bytes = 0
+        self.gauges: dict[str, float] = {}
+        self.peak_rss = 0
+        self.open_peaks: list[int] = []
+
+    @contextmanager
+    def step(self, name: str) -> Iterator[None]:
+        wall = time.perf_counter()
+        cpu = cpu_time()
+        rows = sum(self.rows.values())
+        waited = self.waited
+        # Resetting the peak hides it from steps still running, so it's
+        # carried over to them (and the run) by hand
+        self._carry_peak(peak_rss())
+        self.open_peaks.append(0)
+        reset_peak_rss()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - wall
+            written = sum(self.rows.values()) - rows
+            step_peak = max(self.open_peaks.pop(), peak_rss())
+            self._carry_peak(step_peak)
+            self.steps[name] = {
+                "wall_s": elapsed,
+                "cpu_s": cpu_time() - cpu,
+                "rows": written,
+                "rows_per_s": written / elapsed if elapsed > 0 else 0.0,
+                "writer_wait_s": self.waited - waited,
+                "peak_rss_kb": step_peak,
+            }
+
+    def _carry_peak(self, peak: int):
+        self.peak_rss = max(self.peak_rss, peak)
+        self.open_peaks = [max(p, peak) for p in self.open_peaks]
+
+    def flush(self, batches: list[tuple[Statement, list[tuple]]], seconds: float):
+        with self.lock:
+            for statement, rows in batches:
+                self.rows[statement.table] += len(rows)
+            self.latencies.append(seconds)
+
+    def wait(self, seconds: float):
+        # Time producers spent blocked on the writer
+        self.waited += seconds
+
+    def dump_read(self, count: int):
+        self.dump_bytes += count
+
+    def gauge(self, name: str, value: float):
+        self.gauges[name] = value
+
+    def summary(self) -> dict[str, Any]:
+        wall = time.perf_counter() - self.start_wall
+        with self.lock:
+            latencies = [l * 1000 for l in self.latencies]
+            rows = dict(self.rows)
+        return {
+            "started": self.started.isoformat(),
+            "wall_s": wall,
+            "cpu_s": cpu_time() - self.start_cpu,
+            "peak_rss_kb": max(self.peak_rss, peak_rss()),
+            "peak_rss_children_kb": resource.getrusage(
+                resource.RUSAGE_CHILDREN
+            ).ru_maxrss,
+            "dump_bytes": self.dump_bytes,
+            "rows": sum(rows.values()),
+            "rows_per_s": sum(rows.values()) / wall if wall > 0 else 0.0,
+            "tables": rows,
+            "flushes": {
+                "count": len(latencies),
+                "p50_ms": percentile(latencies, 50),
+                "p95_ms": percentile(latencies, 95),
+                "p99_ms": percentile(latencies, 99),
+                "max_ms": max(latencies, default=0.0),
+            },
+            "writer_wait_s": self.waited,
+            "gauges": self.gauges,
+            "steps": self.steps,
+        }
+
+    def report(self, options: dict[str, Any]):
+        if not self.path:
+            return
+        summary = self.summary()
+        summary["options"] = {
+            k: v for k, v in options.items() if not k.endswith("password")
+        }
+        with open(self.path, "a") as report_file:
+            report_file.write(json.dumps(summary, default=str) + "\n")
@@ -0,0 +1,107 @@
+from typing import Union
+import re
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+POPULARITY_PATTERN = re.compile(
+    r"^(?P<kind>uniform|zipf|lognormal)(:(?P<param>[0-9.]+))?(?P<pages>\+pages)?$"
+)
+
+
+class AliasTable:
+    """
+    Vose alias table over IDs 0..n-1: an ID is drawn from two uniforms in
+    O(1), whatever the weights. Built with the sweep construction (lights
+    are filled from the heavies in order, a heavy that drops below 1 is
+    filled from the next one), vectorized over cumulative sums.
+    """
+
+    def __init__(self, weights):
+        n = len(weights)
+        scaled = np.asarray(weights, dtype=np.float64)
+        scaled = scaled * (n / scaled.sum())
+        lights = np.flatnonzero(scaled < 1)
+        heavies = np.flatnonzero(scaled >= 1)
+        self.prob = np.ones(n, dtype=np.float64)
+        self.alias = np.arange(n, dtype=np.int64)
+        if len(lights) == 0:
+            return
+
+        # Deficit filled before each light, surplus given up to each heavy
+        filled = np.cumsum(1 - scaled[lights])
+        before = filled - (1 - scaled[lights])
+        surplus = np.cumsum(scaled[heavies] - 1)
+
+        donor = np.minimum(np.searchsorted(surplus, before, side="left"), len(heavies) - 1)
+        self.prob[lights] = scaled[lights]
+        self.alias[lights] = heavies[donor]
+
+        # A heavy drops below 1 at the first light it can't cover
+        drop = np.searchsorted(filled, surplus, side="right")
+        dropped = drop < len(lights)
+        dropped[-1] = False
+        self.prob[heavies[dropped]] = np.clip(
+            1 + surplus[dropped] - filled[drop[dropped]], 0, 1
+        )
+        self.alias[heavies[dropped]] = heavies[np.flatnonzero(dropped) + 1]
+
+    def __len__(self) -> int:
+        return len(self.prob)
+
+    def sample(self, u1: float, u2: float) -> int:
+        i = int(u1 * len(self.prob))
+        return i if u2 < self.prob[i] else int(self.alias[i])
+
+    def pick(self, u1, u2):
+        i = (u1 * len(self.prob)).astype(np.int64)
+        return np.where(u2 < self.prob[i], i, self.alias[i])
+
+
+def build_popularity(
+    spec: str, count: int, pages, seed: int
+) -> Union[AliasTable, None]:
+    """
+    Alias table for a POPULARITY_* spec over `count` IDs, None for uniform.
+    zipf:s gives the r-th most popular ID weight 1/r^s, with ranks shuffled
+    so hot IDs are spread out. lognormal:sigma draws each weight from
+    lognormal(0, sigma). +pages multiplies weights by page count (books).
+    """
+    match = POPULARITY_PATTERN.match(spec.replace(" ", ""))
+    if not match:
+        raise ValueError("Unknown popularity: " + spec)
+    if match.group("kind") == "uniform" and not match.group("pages"):
+        return None
+    if np is None:
+        raise ImportError("Popularity other than uniform requires the numpy package")
+
+    rng = np.random.default_rng(seed)
+    param = float(match.group("param") or 1)
+    if match.group("kind") == "zipf":
+        weights = 1 / (rng.permutation(count) + 1.0) ** param
+    elif match.group("kind") == "lognormal":
+        weights = rng.lognormal(0, param, count)
+    else:
+        weights = np.ones(count)
+
+    if match.group("pages"):
+        if pages is None:
+            raise ValueError("+pages only applies to books: " + spec)
+        lengths = np.ones(count)
+        known = np.frombuffer(pages.pages, dtype=np.uint64)[:count]
+        lengths[: len(known)] = np.maximum(known, 1)
+        weights = weights * lengths
+    return AliasTable(weights)
+
+
+def relationship_popularity(
+    context, relationship: str, entity: str, seed: int
+) -> Union[AliasTable, None]:
+    return build_popularity(
+        context.options["popularity_" + relationship],
+        context.ids[entity] + 1,
+        context.atomics.pages if entity == "editions" else None,
+        seed,
+    )
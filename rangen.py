@@ -1,8 +1,11 @@
 from util import GeneratorContext
+from steps.tables import load_spec, load_tables
+from markov import generate_words
+from loaders import Statement, FlushError, parse_insert, flush_batches
 from dataclasses import dataclass
-from typing import Literal, Union
+from typing import Iterator, Literal, Union
 from datetime import datetime, timedelta
-from rich.progress import track, Progress
+from rich.progress import Progress
 from rich import print
 import random
 
@@ -33,9 +36,9 @@ class Book:
 
 
 def generate_contributors(
-    context: GeneratorContext, max_id: int
+    context: GeneratorContext, max_id: int, count: int
 ) -> tuple[list[Contributor], list[Contributor], list[Contributor]]:
-    print("[green][bold]Generating contributors...[/bold][/green]")
+    """Contributor pools for `count` books, with IDs from `max_id` up."""
     names_generator = context.get_markov("names", 4)
     words_generator = context.get_markov("words", 4)
 
@@ -45,41 +48,36 @@ def generate_contributors(
 
     cid = max_id
 
-    for i in track(
-        range(context.options["rand_count"] * MAX_AUTHORS),
-        description="\tGenerating authors...",
-    ):
+    names = generate_words(names_generator, count * MAX_AUTHORS * 2, 25)
+    for i in range(count * MAX_AUTHORS):
         authors.append(
             Contributor(
                 id=cid,
-                first=names_generator.generate_word()[:25],
-                last=names_generator.generate_word()[:25],
+                first=names[i * 2],
+                last=names[i * 2 + 1],
             )
         )
         cid += 1
 
-    for i in track(
-        range(context.options["rand_count"] * MAX_AUTHORS),
-        description="\tGenerating editors...",
-    ):
+    names = generate_words(names_generator, count * MAX_AUTHORS * 2, 25)
+    for i in range(count * MAX_AUTHORS):
         editors.append(
             Contributor(
                 id=cid,
-                first=names_generator.generate_word()[:25],
-                last=names_generator.generate_word()[:25],
+                first=names[i * 2],
+                last=names[i * 2 + 1],
             )
         )
         cid += 1
 
-    for i in track(
-        range(context.options["rand_count"] // 4),
-        description="\tGenerating publishers...",
-    ):
+    # At least MAX_AUTHORS, so every book can sample its publishers
+    words = generate_words(words_generator, max(count // 4, MAX_AUTHORS), 25)
+    for i in range(len(words)):
         publishers.append(
             Contributor(
                 id=cid,
                 first=None,
-                last=words_generator.generate_word()[:25]
+                last=words[i]
                 + " "
                 + random.choice(
                     [
@@ -106,13 +104,13 @@ def build_books(
     genres: list[int],
     audiences: list[int],
     start_id: int,
+    count: int,
 ) -> list[Book]:
-    print("[green][bold]Generating books...[/bold][/green]")
     words_generator = context.get_markov("words", 4)
     bid = start_id
     results = []
 
-    for i in track(range(context.options["rand_count"])):
+    for i in range(count):
         results.append(
             Book(
                 id=bid,
@@ -140,134 +138,204 @@ def build_books(
     return results
 
 
+def book_chunks(
+    context: GeneratorContext,
+    genres: list[int],
+    audiences: list[int],
+    contributor_id: int,
+    book_id: int,
+) -> Iterator[list[Book]]:
+    """
+    GENERATE books in chunks of GENERATE_CHUNK, each with its own contributor
+    pools, so only one chunk is in memory at a time.
+    """
+    remaining = context.options["rand_count"]
+    while remaining > 0:
+        count = min(context.options["rand_chunk"], remaining)
+        authors, editors, publishers = generate_contributors(
+            context, contributor_id, count
+        )
+        contributor_id += len(authors) + len(editors) + len(publishers)
+        yield build_books(
+            context, authors, editors, publishers, genres, audiences, book_id, count
+        )
+        book_id += count
+        remaining -= count
+
+
 def current_data(
     context: GeneratorContext,
-) -> tuple[list[int], list[int], list[int], list[int], list[int], list[int]]:
+) -> tuple[list[int], list[int], list[int], int, int, int]:
     print("[green][bold]Getting current IDs...[/bold][/green]")
 
     audiences = [i[0] for i in context.db.execute("SELECT id FROM audiences")]
-    books = [i[0] for i in context.db.execute("SELECT id FROM books")]
-    contributors = [i[0] for i in context.db.execute("SELECT id FROM contributors")]
     genres = [i[0] for i in context.db.execute("SELECT id FROM genres")]
     users = [i[0] for i in context.db.execute("SELECT id FROM users")]
-    sessions = [
-        i[0] for i in context.db.execute("SELECT session_id FROM users_sessions")
-    ]
-    return audiences, books, contributors, genres, users, sessions
-
-
-def make_read_session(book: Book, user: int, id: int) -> list:
+    # Only the highest IDs are needed, new rows are numbered after them
+    max_book = context.db.execute("SELECT COALESCE(MAX(id), -1) FROM books").fetchone()[0]
+    max_contributor = context.db.execute(
+        "SELECT COALESCE(MAX(id), -1) FROM contributors"
+    ).fetchone()[0]
+    max_session = context.db.execute(
+        "SELECT COALESCE(MAX(session_id), -1) FROM users_sessions"
+    ).fetchone()[0]
+    return audiences, genres, users, max_book, max_contributor, max_session
+
+
+def make_read_session(book: Book, user: int, id: int) -> tuple:
     start = book.release + timedelta(seconds=random.randint(100, 1000000))
     end = start + timedelta(seconds=random.randint(100, 3600))
     start_page = random.randint(0, book.length)
-    end_page = random.randint(start_page + 1, book.length)
-    return [id, book.id, user, start, end, start_page, end_page]
+    end_page = random.randint(start_page, book.length)
+    return (id, book.id, user, start, end, start_page, end_page)
+
+
+def register_statements(context: GeneratorContext) -> dict[str, Statement]:
+    # In the order they're written, contributors and books before links
+    return {
+        table: parse_insert(
+            "INSERT INTO "
+            + context.table(table)
+            + " "
+            + columns
+            + " ON CONFLICT DO NOTHING"
+        )
+        for table, columns in [
+            ("books", "(id, title, length, edition, release_dt, isbn) VALUES (:id, :title, :length, :edition, :release_dt, :isbn)"),
+            ("contributors", "(id, name_first, name_last_company) VALUES (:id, :first, :last)"),
+            ("books.authors", "(book_id, contributor_id) VALUES (:bid, :cid)"),
+            ("books.editors", "(book_id, contributor_id) VALUES (:bid, :cid)"),
+            ("books.publishers", "(book_id, contributor_id) VALUES (:bid, :cid)"),
+            ("books.audiences", "(book_id, audience_id) VALUES (:bid, :aid)"),
+            ("books.genres", "(book_id, genre_id) VALUES (:bid, :gid)"),
+            ("users.sessions", "(session_id, book_id, user_id, start_datetime, end_datetime, start_page, end_page) VALUES (:sid, :bid, :uid, :sdt, :edt, :sp, :ep)"),
+            ("users.ratings", "(book_id, user_id, rating) VALUES (:bid, :uid, :rating)"),
+        ]
+    }
+
+
+def book_rows(book: Book, users_ids: list[int], sid: int) -> dict[str, list[tuple]]:
+    """Rows for one book by statement, drawn once so a retry writes the same."""
+    contributors = book.authors + book.editors + book.publishers
+    user_read_ids = random.sample(users_ids, random.randint(2, 30))
+    user_rate_ids = random.sample(users_ids, random.randint(2, 30))
+    return {
+        "books": [
+            (book.id, book.title, book.length, book.edition, book.release, book.isbn)
+        ],
+        "contributors": [(c.id, c.first, c.last) for c in contributors],
+        "books.authors": [(book.id, c.id) for c in book.authors],
+        "books.editors": [(book.id, c.id) for c in book.editors],
+        "books.publishers": [(book.id, c.id) for c in book.publishers],
+        "books.audiences": [(book.id, a) for a in book.audiences],
+        "books.genres": [(book.id, g) for g in book.genres],
+        "users.sessions": [
+            make_read_session(book, user, sid + n)
+            for n, user in enumerate(user_read_ids)
+        ],
+        "users.ratings": [(book.id, i, random.randint(0, 5)) for i in user_rate_ids],
+    }
+
+
+def merge_rows(
+    statements: dict[str, Statement], books: list[dict[str, list[tuple]]]
+) -> list[tuple[Statement, list[tuple]]]:
+    batches = []
+    for name, statement in statements.items():
+        rows = [row for book in books for row in book[name]]
+        if name == "contributors":
+            # Books in a chunk share contributors, write each one once
+            rows = list({row[0]: row for row in rows}.values())
+        if len(rows) > 0:
+            batches.append((statement, rows))
+    return batches
 
 
 def main(context: GeneratorContext):
+    if context.db is None:
+        # Existing IDs are read back from the database, and rows go straight to it
+        raise ValueError("rangen.py needs a database, SINK = files isn't supported")
+    try:
+        generate(context)
+    finally:
+        context.cleanup()
+
+
+def generate(context: GeneratorContext):
     (
         audiences_ids,
-        books_ids,
-        contributors_ids,
         genres_ids,
         users_ids,
-        sessions_ids,
+        max_book,
+        max_contributor,
+        max_session,
     ) = current_data(context)
-    authors, editors, publishers = generate_contributors(
-        context, max(contributors_ids, default=-1) + 1
-    )
-    books = build_books(
-        context,
-        authors,
-        editors,
-        publishers,
-        genres_ids,
-        audiences_ids,
-        max(books_ids, default=-1) + 1,
-    )
 
-    # Upload data
-    print("[green][bold]Pushing data...[/bold][/green]")
-    sid = max(sessions_ids, default=-1) + 1
+    # Chunks are generated and uploaded one at a time
+    print("[green][bold]Generating and pushing data...[/bold][/green]")
+    load_tables(context, load_spec(context))
+    statements = register_statements(context)
+    sid = max_session + 1
     with Progress() as progress:
-        task = progress.add_task("Uploading...", total=len(books))
-        for book in books:
-            try:
-                context.db.execute(
-                    "INSERT INTO books (id, title, length, edition, release_dt, isbn) VALUES (%s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING",
-                    [
-                        book.id,
-                        book.title,
-                        book.length,
-                        book.edition,
-                        book.release,
-                        book.isbn,
-                    ],
-                )
-                for author in book.authors:
-                    context.db.execute(
-                        "INSERT INTO contributors (id, name_first, name_last_company) VALUES (%s, %s, %s) ON CONFLICT DO NOTHING",
-                        [author.id, author.first, author.last],
-                    )
-                    context.db.execute(
-                        "INSERT INTO books_authors (book_id, contributor_id) VALUES (%s, %s) ON CONFLICT DO NOTHING",
-                        [book.id, author.id],
-                    )
-
-                for editor in book.editors:
-                    context.db.execute(
-                        "INSERT INTO contributors (id, name_first, name_last_company) VALUES (%s, %s, %s) ON CONFLICT DO NOTHING",
-                        [editor.id, editor.first, editor.last],
-                    )
-                    context.db.execute(
-                        "INSERT INTO books_editors (book_id, contributor_id) VALUES (%s, %s) ON CONFLICT DO NOTHING",
-                        [book.id, editor.id],
-                    )
-
-                for publisher in book.publishers:
-                    context.db.execute(
-                        "INSERT INTO contributors (id, name_first, name_last_company) VALUES (%s, %s, %s) ON CONFLICT DO NOTHING",
-                        [publisher.id, publisher.first, publisher.last],
-                    )
-                    context.db.execute(
-                        "INSERT INTO books_publishers (book_id, contributor_id) VALUES (%s, %s) ON CONFLICT DO NOTHING",
-                        [book.id, publisher.id],
-                    )
-
-                for audiences in book.audiences:
-                    context.db.execute(
-                        "INSERT INTO books_audiences (book_id, audience_id) VALUES (%s, %s) ON CONFLICT DO NOTHING",
-                        [book.id, audiences],
-                    )
-
-                for genre in book.genres:
-                    context.db.execute(
-                        "INSERT INTO books_genres (book_id, genre_id) VALUES (%s, %s) ON CONFLICT DO NOTHING",
-                        [book.id, genre],
-                    )
-
-                user_read_ids = random.sample(users_ids, random.randint(2, 30))
-                scr = context.db.cursor()
-                scr.executemany(
-                    "INSERT INTO users_sessions (session_id, book_id, user_id, start_datetime, end_datetime, start_page, end_page) VALUES (%s, %s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING",
-                    [
-                        make_read_session(book, i, sid + user_read_ids.index(i))
-                        for i in user_read_ids
-                    ],
-                )
-                sid += len(user_read_ids)
+        task = progress.add_task("Uploading...", total=context.options["rand_count"])
+        for books in book_chunks(
+            context,
+            genres_ids,
+            audiences_ids,
+            max_contributor + 1,
+            max_book + 1,
+        ):
+            sid = upload_books(context, statements, books, users_ids, sid, progress)
+            progress.update(task, advance=len(books))
+
+
+def upload_books(
+    context: GeneratorContext,
+    statements: dict[str, Statement],
+    books: list[Book],
+    users_ids: list[int],
+    sid: int,
+    progress: Progress,
+) -> int:
+    """
+    Writes a chunk in one transaction, grouped by table. If that fails, the
+    chunk is retried one book per transaction so only the bad books are lost.
+    """
+    rows = []
+    for book in books:
+        rows.append(book_rows(book, users_ids, sid))
+        sid += len(rows[-1]["users.sessions"])
+
+    try:
+        flush_batches(
+            context.db,
+            context.loader,
+            merge_rows(statements, rows),
+            context.options["db_pipeline"],
+        )
+        return sid
+    except FlushError as e:
+        progress.console.print(
+            "\t[yellow]Chunk of {count} books failed, retrying one by one: {error}[/yellow]".format(
+                count=len(books), error=e
+            )
+        )
 
-                user_rate_ids = random.sample(users_ids, random.randint(2, 30))
-                rcr = context.db.cursor()
-                rcr.executemany(
-                    "INSERT INTO users_ratings (book_id, user_id, rating) VALUES (%s, %s, %s) ON CONFLICT DO NOTHING",
-                    [[book.id, i, random.randint(0, 5)] for i in user_rate_ids],
+    for book, single in zip(books, rows):
+        try:
+            flush_batches(
+                context.db,
+                context.loader,
+                merge_rows(statements, [single]),
+                context.options["db_pipeline"],
+            )
+        except FlushError as e:
+            progress.console.print(
+                "\t[red][bold]Upload Error:[/bold] Book {id} failed: {error}[/red]".format(
+                    id=book.id, error=e
                 )
-
-                context.db.commit()
-            except:
-                context.db.rollback()
-            progress.update(task, advance=1)
+            )
+    return sid
 
 
 if __name__ == "__main__":
@@ -0,0 +1,76 @@
+from typing import Union
+import dbm
+import re
+
+AUTHOR_KEY = re.compile(r"^/authors/OL(\d+)A$")
+
+
+class AuthorResolver:
+    """
+    Maps Open Library author keys to contributor IDs while the dump is read.
+    Keys of the usual /authors/OL<n>A shape are stored as ints. Once more than
+    `budget` keys are held in memory they are moved to an on-disk dbm hash.
+    Editions referencing authors that haven't been seen yet are kept until
+    the author shows up.
+    """
+
+    def __init__(self, budget: int, spill_path: str):
+        self.budget = budget
+        self.spill_path = spill_path
+        self.keys: dict[Union[int, str], int] = {}
+        self.pending: dict[Union[int, str], list[int]] = {}
+        self.spill = None
+
+    def author(self, key: str, contributor_id: int) -> list[int]:
+        compact = self._compact(key)
+        self.keys[compact] = contributor_id
+        if len(self.keys) > self.budget:
+            self._spill()
+        return self.pending.pop(compact, [])
+
+    def edition(self, book_id: int, keys: list[str]) -> list[int]:
+        resolved = []
+        for key in dict.fromkeys(keys):
+            compact = self._compact(key)
+            contributor_id = self._lookup(compact)
+            if contributor_id is None:
+                self.pending.setdefault(compact, []).append(book_id)
+            else:
+                resolved.append(contributor_id)
+        return resolved
+
+    def unresolved(self) -> int:
+        return len(set([b for books in self.pending.values() for b in books]))
+
+    def _compact(self, key: str) -> Union[int, str]:
+        match = AUTHOR_KEY.match(key)
+        return int(match.group(1)) if match else key
+
+    def _lookup(self, compact: Union[int, str]) -> Union[int, None]:
+        if compact in self.keys.keys():
+            return self.keys[compact]
+        if self.spill is not None:
+            value = self.spill.get(str(compact).encode("utf-8"))
+            if value is not None:
+                return int(value)
+        return None
+
+    def _spill(self):
+        if self.spill is None:
+            self.spill = dbm.open(self.spill_path, "n")
+        for compact, contributor_id in self.keys.items():
+            self.spill[str(compact).encode("utf-8")] = str(contributor_id).encode("utf-8")
+        self.keys = {}
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        if self.spill is not None:
+            if hasattr(self.spill, "sync"):
+                self.spill.sync()
+            state["spill"] = True
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        if self.spill:
+            self.spill = dbm.open(self.spill_path, "w")
@@ -2,8 +2,17 @@ import dotenv
 dotenv.load_dotenv()
 
 import os
-with open(os.getenv("DATA_EXT", "ol_dump.ext"), "r") as source:
-    with open(os.getenv("DATA_PATH", "ol_dump.dump"), "w") as sink:
-        for line in source:
-            if line.split("\t")[0] in ["/type/author", "/type/edition"]:
-                sink.write(line)
\ No newline at end of file
+from dump import DumpReader, IndexBuilder
+
+BLOCK_SIZE = 16 * 1024 * 1024
+
+sink_path = os.getenv("DATA_PATH", "ol_dump.dump")
+index = IndexBuilder()
+with DumpReader(os.getenv("DATA_EXT", "ol_dump.ext"), BLOCK_SIZE) as source:
+    with open(sink_path, "wb", buffering=BLOCK_SIZE) as sink:
+        for block in source:
+            if len(block.data) == 0:
+                continue
+            index.add(block.data, sink.tell())
+            sink.write(block.data + b"\n")
+index.write(os.getenv("DATA_INDEX", sink_path + ".idx"))
@@ -0,0 +1,238 @@
+from typing import Any, BinaryIO, Callable
+from datetime import date, datetime, timedelta
+from loaders import Statement, CopyLoader, CopyPlan
+from metrics import Metrics
+import gzip
+import json
+import os
+import shlex
+import struct
+import time
+
+COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+COPY_TRAILER = struct.pack(">h", -1)
+PG_EPOCH = datetime(2000, 1, 1)
+
+BINARY_ENCODERS: dict[str, Callable[[Any], bytes]] = {
+    "bigint": lambda v: struct.pack(">q", v),
+    "int8": lambda v: struct.pack(">q", v),
+    "integer": lambda v: struct.pack(">i", v),
+    "int": lambda v: struct.pack(">i", v),
+    "int4": lambda v: struct.pack(">i", v),
+    "smallint": lambda v: struct.pack(">h", v),
+    "int2": lambda v: struct.pack(">h", v),
+    "boolean": lambda v: b"\x01" if v else b"\x00",
+    "bool": lambda v: b"\x01" if v else b"\x00",
+    "text": lambda v: str(v).encode("utf-8"),
+    "varchar": lambda v: str(v).encode("utf-8"),
+    "timestamp": lambda v: struct.pack(
+        ">q", (v - PG_EPOCH) // timedelta(microseconds=1)
+    ),
+    "date": lambda v: struct.pack(">i", (v - PG_EPOCH.date()).days),
+}
+
+TEXT_ESCAPES = str.maketrans(
+    {"\\": "\\\\", "\n": "\\n", "\r": "\\r", "\t": "\\t"}
+)
+
+
+def encode_text(row: tuple) -> bytes:
+    fields = []
+    for value in row:
+        if value is None:
+            fields.append("\\N")
+        elif isinstance(value, bool):
+            fields.append("t" if value else "f")
+        elif isinstance(value, datetime):
+            fields.append(value.isoformat(" "))
+        elif isinstance(value, date):
+            fields.append(value.isoformat())
+        else:
+            fields.append(str(value).translate(TEXT_ESCAPES))
+    return ("\t".join(fields) + "\n").encode("utf-8")
+
+
+def encode_binary(row: tuple, types: list[str]) -> bytes:
+    parts = [struct.pack(">h", len(row))]
+    for value, type in zip(row, types):
+        if value is None:
+            parts.append(struct.pack(">i", -1))
+        else:
+            data = BINARY_ENCODERS[type](value)
+            parts.append(struct.pack(">i", len(data)))
+            parts.append(data)
+    return b"".join(parts)
+
+
+class SinkFile:
+    def __init__(
+        self, path: str, plan: CopyPlan, compress: bool, entry: dict[str, Any]
+    ):
+        self.path = path
+        self.plan = plan
+        self.entry = entry
+        self.rows = 0
+        self.handle: BinaryIO = gzip.open(path, "wb") if compress else open(path, "wb")
+        if plan.binary:
+            self.handle.write(COPY_SIGNATURE)
+
+    def write(self, rows: list[tuple]):
+        if self.plan.binary:
+            self.handle.write(
+                b"".join([encode_binary(row, self.plan.types) for row in rows])
+            )
+        else:
+            self.handle.write(b"".join([encode_text(row) for row in rows]))
+        self.rows += len(rows)
+
+    def close(self):
+        if self.plan.binary:
+            self.handle.write(COPY_TRAILER)
+        self.handle.close()
+
+
+class FileSink:
+    """
+    Writer that stores batches as COPY files (one series per statement,
+    split every `chunk_rows` rows) instead of sending them to a database.
+    Statements run through execute() are recorded in the manifest in order;
+    files started after one only load after it. close() writes manifest.json
+    and a load.sh that replays everything with psql, loading the files
+    between two statements in parallel.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        types: dict[str, dict[str, str]],
+        binary: bool,
+        compression: str,
+        chunk_rows: int,
+        metrics: Metrics,
+        unkeyed: set[str] = set(),
+    ):
+        if not compression in ["none", "gzip"]:
+            raise ValueError("Unknown SINK_COMPRESSION: " + compression)
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.planner = CopyLoader(types, binary, unkeyed)
+        self.compress = compression == "gzip"
+        self.chunk_rows = chunk_rows
+        self.metrics = metrics
+        self.files: dict[str, SinkFile] = {}
+        self.counts: dict[str, int] = {}
+        self.manifest: list[dict[str, Any]] = []
+
+    def submit(self, statement: Statement, rows: list[tuple]):
+        if not statement.copyable:
+            raise ValueError(
+                "Statement can't be written as COPY data: " + statement.query
+            )
+        started = time.perf_counter()
+        batch = [(statement, rows)]
+        while len(rows) > 0:
+            sink_file = self._file(statement)
+            count = min(len(rows), self.chunk_rows - sink_file.rows)
+            sink_file.write(rows[:count])
+            rows = rows[count:]
+            if sink_file.rows >= self.chunk_rows:
+                self._close_file(statement.query)
+        self.metrics.flush(batch, time.perf_counter() - started)
+
+    def execute(self, query: str):
+        self._close_files()
+        self.manifest.append({"sql": query})
+
+    def drain(self):
+        for sink_file in self.files.values():
+            sink_file.handle.flush()
+
+    def close(self):
+        self._close_files()
+        with open(os.path.join(self.path, "manifest.json"), "w") as manifest:
+            json.dump(self.manifest, manifest, indent=4)
+        script_path = os.path.join(self.path, "load.sh")
+        with open(script_path, "w") as script:
+            script.write(self.load_script())
+        os.chmod(script_path, 0o755)
+
+    def load_script(self) -> str:
+        lines = [
+            "#!/bin/sh",
+            "# Connection settings are taken from the PG* environment variables",
+            "set -e",
+            'cd "$(dirname "$0")"',
+            "JOBS=${JOBS:-4}",
+            'pids=""',
+            "",
+            "load() {",
+            '    file="$1"',
+            "    shift",
+            '    case "$file" in',
+            '        *.gz) gzip -dc "$file" ;;',
+            '        *) cat "$file" ;;',
+            "    esac | psql -X -q -v ON_ERROR_STOP=1 -1 \"$@\"",
+            "}",
+            "",
+            "wait_all() {",
+            "    for pid in $pids; do wait $pid; done",
+            '    pids=""',
+            "}",
+            "",
+            "spawn() {",
+            '    load "$@" &',
+            '    pids="$pids $!"',
+            "    set -- $pids",
+            '    if [ $# -ge "$JOBS" ]; then wait_all; fi',
+            "}",
+            "",
+        ]
+        for entry in self.manifest:
+            if "sql" in entry.keys():
+                lines.append("wait_all")
+                lines.append(
+                    "psql -X -q -v ON_ERROR_STOP=1 -c " + shlex.quote(entry["sql"])
+                )
+            else:
+                commands = entry["before"] + [entry["copy"]] + entry["after"]
+                lines.append(
+                    "spawn "
+                    + shlex.quote(entry["file"])
+                    + "".join([" -c " + shlex.quote(c) for c in commands])
+                )
+        lines.append("wait_all")
+        return "\n".join(lines) + "\n"
+
+    def _file(self, statement: Statement) -> SinkFile:
+        if not statement.query in self.files.keys():
+            index = self.counts.get(statement.table, 0)
+            self.counts[statement.table] = index + 1
+            plan = self.planner.plan(statement)
+            name = "{table}.{index:04d}.{format}{ext}".format(
+                table=statement.table,
+                index=index,
+                format="bin" if plan.binary else "txt",
+                ext=".gz" if self.compress else "",
+            )
+            entry = {
+                "table": statement.table,
+                "file": name,
+                "rows": 0,
+                "before": plan.before,
+                "copy": plan.copy,
+                "after": plan.after,
+            }
+            self.manifest.append(entry)
+            self.files[statement.query] = SinkFile(
+                os.path.join(self.path, name), plan, self.compress, entry
+            )
+        return self.files[statement.query]
+
+    def _close_file(self, query: str):
+        sink_file = self.files.pop(query)
+        sink_file.close()
+        sink_file.entry["rows"] = sink_file.rows
+
+    def _close_files(self):
+        for query in list(self.files.keys()):
+            self._close_file(query)
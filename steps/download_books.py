@@ -12,13 +12,18 @@ from rich.progress import (
     TimeElapsedColumn,
 )
 from rich.console import Console
-import json
 from typing_extensions import TypedDict
+from typing import NamedTuple, Union, Iterator
+from concurrent.futures import ProcessPoolExecutor, Future
+from collections import deque, Counter
 import string
-import dateutil.parser
+from dates import PublishDateParser
+from decoders import make_decoder
+from dump import DumpReader, is_compressed, filter_records, read_index, find_author
 import os
 import time
 import datetime
+import random
 
 EDITION_REQUIRED_KEYS = [
     "title",
@@ -32,6 +37,21 @@ EDITION_OPTIONAL_KEYS = ["publishers", "genres"]
 
 AUTHOR_REQUIRED_KEYS = ["name"]
 
+# Cheap substring checks on the raw JSON, run before decoding it
+REQUIRED_PATTERNS = {
+    "/type/edition": [(k, '"' + k + '"') for k in EDITION_REQUIRED_KEYS],
+    "/type/author": [(k, '"' + k + '"') for k in AUTHOR_REQUIRED_KEYS],
+}
+EMPTY_PATTERNS = {
+    "/type/edition": [
+        ("no authors", ['"authors": []', '"authors":[]']),
+        ("no isbn_13", ['"isbn_13": []', '"isbn_13":[]']),
+    ],
+    "/type/author": [],
+}
+
+SERIAL_BLOCK_SIZE = 1024 * 1024
+
 
 class TrimmedEdition(TypedDict):
     edition_name: str
@@ -48,218 +68,608 @@ class TrimmedAuthor(TypedDict):
     name: str
 
 
-def download_books_main(context: GeneratorContext):
-    print("[green][bold]STEP: [/bold] Processing books...[/green]")
-    ls = int(time.time())
-    with open(context.options["data_path"], "r") as data_stream:
-        if context.options["data_limit"]:
-            progress = Progress(
-                TextColumn("\t"),
-                SpinnerColumn(),
-                TextColumn("{task.description}"),
-                BarColumn(),
-                TaskProgressColumn(),
-                MofNCompleteColumn(),
-                TimeElapsedColumn(),
-            )
-        else:
-            progress = Progress(
-                TextColumn("\t"),
-                SpinnerColumn(),
-                TextColumn("{task.description}"),
-                BarColumn(),
-                TaskProgressColumn(),
-                FileSizeColumn(),
-                TextColumn("/"),
-                TotalFileSizeColumn(),
-                TimeElapsedColumn(),
-            )
-        bytesize = 0
-        count = 0
-        if context.options["data_limit"]:
-            task = progress.add_task(
-                "[green]Processing data...", total=context.options["data_limit"]
-            )
-        else:
-            task = progress.add_task(
-                "[green]Processing data...",
-                total=os.stat(context.options["data_path"]).st_size,
-            )
+class AuthorRecord(NamedTuple):
+    key: str
+    first_name: str
+    last_name: str
 
-        progress.start()
-
-        for line in data_stream:
-            bytesize += len(line)
-            try:
-                if process_line(context, line.strip(" \n"), progress.console):
-                    count += 1
-            except KeyboardInterrupt:
-                exit(0)
-            except SystemExit:
-                progress.console.print(
-                    "\t[red][bold]Line Error:[/bold] {data}[/red]".format(
-                        data=line.strip(" \n")
-                    )
-                )
 
-            if int(time.time()) != ls:
-                ls = int(time.time())
-                if context.options["data_limit"]:
-                    progress.update(task, completed=count)
-                else:
-                    progress.update(task, completed=bytesize)
-                progress.refresh()
+class EditionRecord(NamedTuple):
+    key: str
+    title: str
+    length: int
+    edition: str
+    release: int
+    isbn: int
+    genres: list[str]
+    publishers: list[str]
+    authors: list[str]
 
-            if context.options["data_limit"] and count > context.options["data_limit"]:
-                break
-    progress.stop()
-    context.clean_cache()
 
+class ChunkResult(NamedTuple):
+    records: list[Union[AuthorRecord, EditionRecord]]
+    errors: list[str]
+    end: int
+    stats: Counter
 
-def store_author(
-    id: str, data: dict, context: GeneratorContext, console: Console
-) -> bool:
-    if not all([k in data.keys() for k in AUTHOR_REQUIRED_KEYS]):
-        return False
 
-    trimmed: TrimmedAuthor = {
-        k: v for k, v in data.items() if k in AUTHOR_REQUIRED_KEYS
-    }
+class PublishDateError(ValueError):
+    pass
 
-    if len(trimmed["name"].split(" ")) < 2:
-        return False
 
-    mapped_id = context.id("contributors")
-    context.execute_cached(
-        "INSERT INTO "
-        + context.table("contributors")
-        + " (id, name_first, name_last_company) VALUES (:id, :first_name, :last_name) ON CONFLICT DO NOTHING",
-        dict(
-            id=mapped_id,
+class RecordParser:
+    """
+    Turns dump lines into validated records. Lines that can't pass
+    validation are rejected from the raw JSON where possible, and every
+    rejection is counted by reason.
+    """
+
+    def __init__(self, date_cache_size: int, decoder: str):
+        self.dates = PublishDateParser(date_cache_size)
+        self.decode = make_decoder(
+            decoder, EDITION_REQUIRED_KEYS + EDITION_OPTIONAL_KEYS, AUTHOR_REQUIRED_KEYS
+        )
+        self.rejects = Counter()
+
+    def stats(self) -> Counter:
+        stats = Counter(self.dates.stats())
+        stats.update(self.rejects)
+        return stats
+
+    def parse_line(self, line: str) -> Union[AuthorRecord, EditionRecord, None]:
+        parts = line.split("\t")
+        record_type = parts[0]
+        if not record_type in REQUIRED_PATTERNS.keys():
+            return None
+
+        for key, pattern in REQUIRED_PATTERNS[record_type]:
+            if not pattern in parts[4]:
+                self.rejects["rejected: missing " + key] += 1
+                return None
+        for reason, patterns in EMPTY_PATTERNS[record_type]:
+            if any([p in parts[4] for p in patterns]):
+                self.rejects["rejected: " + reason] += 1
+                return None
+
+        record_data = self.decode(record_type, parts[4])
+        if record_type == "/type/author":
+            return self.parse_author(parts[1], record_data)
+        return self.parse_edition(parts[1], record_data)
+
+    def parse_author(self, id: str, data: dict) -> Union[AuthorRecord, None]:
+        if not self._has_keys(data, AUTHOR_REQUIRED_KEYS):
+            return None
+
+        trimmed: TrimmedAuthor = {
+            k: v for k, v in data.items() if k in AUTHOR_REQUIRED_KEYS
+        }
+
+        if len(trimmed["name"].split(" ")) < 2:
+            self.rejects["rejected: single word name"] += 1
+            return None
+
+        return AuthorRecord(
+            key=id,
             first_name=trimmed["name"].split(" ")[0].replace("'", "\\'")[:25],
             last_name=trimmed["name"].split(" ")[-1].replace("'", "\\'")[:50],
-        ),
-    )
-    context.create_mapped("contributors", id, mapped_id)
+        )
 
-    return True
+    def parse_edition(self, id: str, data: dict) -> Union[EditionRecord, None]:
+        if not self._has_keys(data, EDITION_REQUIRED_KEYS):
+            return None
 
+        trimmed: TrimmedEdition = {
+            k: v
+            for k, v in data.items()
+            if k in EDITION_REQUIRED_KEYS or k in EDITION_OPTIONAL_KEYS
+        }
 
-def store_edition(
-    id: str, data: dict, context: GeneratorContext, console: Console
-) -> bool:
-    if not all([k in data.keys() for k in EDITION_REQUIRED_KEYS]):
-        return False
+        if len(trimmed["authors"]) == 0:
+            self.rejects["rejected: no authors"] += 1
+            return None
 
-    trimmed: TrimmedEdition = {
-        k: v
-        for k, v in data.items()
-        if k in EDITION_REQUIRED_KEYS or k in EDITION_OPTIONAL_KEYS
-    }
+        if len(trimmed["isbn_13"]) == 0:
+            self.rejects["rejected: no isbn_13"] += 1
+            return None
 
-    if len(trimmed["authors"]) == 0:
-        return False
+        if trimmed["number_of_pages"] < 1:
+            self.rejects["rejected: no pages"] += 1
+            return None
 
-    if len(trimmed["isbn_13"]) == 0:
-        return False
+        if trimmed["number_of_pages"] >= 2**63:
+            self.rejects["rejected: too many pages"] += 1
+            return None
 
-    if trimmed["number_of_pages"] < 1:
-        return False
+        if any([not i in string.digits for i in trimmed["isbn_13"][0]]):
+            self.rejects["rejected: bad isbn_13"] += 1
+            return None
 
-    if any([not i in string.digits for i in trimmed["isbn_13"][0]]):
-        return False
+        try:
+            parsed_dt = self.dates.parse(trimmed["publish_date"])
+        except ValueError:
+            self.rejects["rejected: bad publish_date"] += 1
+            raise PublishDateError(trimmed["publish_date"])
 
-    try:
-        parsed_dt = int(
-            dateutil.parser.parse(trimmed["publish_date"].replace("?", "")).timestamp()
+        return EditionRecord(
+            key=id,
+            title=trimmed["title"].replace("'", "\\'"),
+            length=trimmed["number_of_pages"],
+            edition=trimmed["edition_name"],
+            release=parsed_dt,
+            isbn=int(trimmed["isbn_13"][0]),
+            genres=[
+                g.lower().replace("-", "").replace(".", "")
+                for g in trimmed.get("genres", [])
+            ],
+            publishers=[p.lower() for p in trimmed.get("publishers", [])],
+            authors=[a["key"] for a in trimmed["authors"] if "key" in a.keys()],
+        )
+
+    def _has_keys(self, data: dict, keys: list[str]) -> bool:
+        for k in keys:
+            if not k in data.keys():
+                self.rejects["rejected: missing " + k] += 1
+                return False
+        return True
+
+
+worker_parser: Union[RecordParser, None] = None
+
+
+def download_books_main(context: GeneratorContext):
+    print("[green][bold]STEP: [/bold] Processing books...[/green]")
+    register_statements(context)
+    if context.options["data_limit"]:
+        progress = Progress(
+            TextColumn("\t"),
+            SpinnerColumn(),
+            TextColumn("{task.description}"),
+            BarColumn(),
+            TaskProgressColumn(),
+            MofNCompleteColumn(),
+            TimeElapsedColumn(),
         )
-    except SystemExit:
-        exit(0)
-    except:
-        console.print(
-            "\t[red][bold]Parse Error:[/bold] Parsing date string {dstring}[/red]".format(
-                dstring=trimmed["publish_date"]
+        task = progress.add_task(
+            "[green]Processing data...", total=context.options["data_limit"]
+        )
+    else:
+        progress = Progress(
+            TextColumn("\t"),
+            SpinnerColumn(),
+            TextColumn("{task.description}"),
+            BarColumn(),
+            TaskProgressColumn(),
+            FileSizeColumn(),
+            TextColumn("/"),
+            TotalFileSizeColumn(),
+            TimeElapsedColumn(),
+        )
+        task = progress.add_task(
+            "[green]Processing data...",
+            total=os.stat(context.options["data_path"]).st_size,
+        )
+
+    progress.start()
+    if context.options["data_workers"] > 1 and context.options["data_sample"] != "random":
+        stats = ingest_parallel(context, progress, task)
+    else:
+        parser = RecordParser(
+            context.options["date_cache_size"], context.options["json_decoder"]
+        )
+        if context.options["data_sample"] == "random":
+            ingest_sample(context, progress, task, parser)
+        else:
+            ingest_serial(context, progress, task, parser)
+        stats = parser.stats()
+    progress.stop()
+    context.clean_cache()
+    print(
+        "\t[grey70 italic]Publish dates: {hits} cache hits, {misses} misses, {fast} fast path, {fallback} dateutil fallbacks ({failed} failed)[/grey70 italic]".format(
+            **stats
+        )
+    )
+    print_atomics_memory(context)
+    for reason, count in sorted(stats.items()):
+        if reason.startswith("rejected: "):
+            print(
+                "\t[grey70 italic]{count} records {reason}[/grey70 italic]".format(
+                    count=count, reason=reason
+                )
             )
+
+
+def print_atomics_memory(context: GeneratorContext):
+    memory = context.atomics.memory()
+    # MB per million editions
+    scale = 1000000 / max(len(context.atomics.pages), 1) / 1024**2
+    for name, size in memory.items():
+        context.metrics.gauge("atomics_" + name + "_bytes", size)
+    print(
+        "\t[grey70 italic]Atomics: {total:.1f} MB for {editions} editions ({per_million:.1f} MB per million: {pages:.1f} pages, {genre:.1f} genres, {publisher:.1f} publishers)[/grey70 italic]".format(
+            total=sum(memory.values()) / 1024**2,
+            editions=len(context.atomics.pages),
+            per_million=sum(memory.values()) * scale,
+            pages=memory["pages"] * scale,
+            genre=memory["genre"] * scale,
+            publisher=memory["publisher"] * scale,
         )
-        return False
+    )
 
-    mapped_id = context.id("editions")
 
-    context.execute_cached(
+def ingest_serial(
+    context: GeneratorContext, progress: Progress, task, parser: RecordParser
+):
+    ls = int(time.time())
+    position = context.checkpoint.position("download_books", {"offset": 0, "count": 0})
+    count = position["count"]
+    read = position["offset"]
+    with DumpReader(
+        context.options["data_path"], SERIAL_BLOCK_SIZE, position["offset"]
+    ) as reader:
+        for block in reader:
+            context.metrics.dump_read(block.consumed - read)
+            read = block.consumed
+            for raw in block.data.split(b"\n"):
+                line = raw.decode("utf-8").strip(" \n")
+                if len(line) == 0:
+                    continue
+                try:
+                    if process_line(context, line, progress.console, parser):
+                        count += 1
+                except KeyboardInterrupt:
+                    exit(0)
+                except SystemExit:
+                    progress.console.print(
+                        "\t[red][bold]Line Error:[/bold] {data}[/red]".format(data=line)
+                    )
+
+                if context.options["data_limit"] and count > context.options["data_limit"]:
+                    return
+
+            if int(time.time()) != ls:
+                ls = int(time.time())
+                if context.options["data_limit"]:
+                    progress.update(task, completed=count)
+                else:
+                    progress.update(task, completed=block.consumed)
+                progress.refresh()
+                context.checkpoint.tick(
+                    "download_books", {"offset": block.offset, "count": count}
+                )
+
+
+def ingest_sample(
+    context: GeneratorContext, progress: Progress, task, parser: RecordParser
+):
+    if not context.options["data_limit"]:
+        raise ValueError("DATA_SAMPLE = random requires DATA_LIMIT")
+    index = read_index(context.options["data_index"])
+    # Every edition in a random order, sampling takes from the front
+    order = random.Random(context.options["data_seed"]).sample(
+        range(len(index.editions)), len(index.editions)
+    )
+
+    editions: list[tuple[int, EditionRecord]] = []
+    author_offsets: dict[int, str] = {}
+    drawn = 0
+    with open(context.options["data_path"], "rb") as data_stream:
+        # Rejected records are replaced by drawing again, until DATA_LIMIT
+        # editions are in or the index runs out
+        while len(editions) < context.options["data_limit"] and drawn < len(order):
+            picks = order[drawn : drawn + context.options["data_limit"] - len(editions)]
+            drawn += len(picks)
+            # Read in file order so the seeks only move forward
+            for offset in sorted([index.editions[p] for p in picks]):
+                try:
+                    record = parser.parse_line(read_line(context, data_stream, offset))
+                except PublishDateError as e:
+                    print_parse_error(progress.console, str(e))
+                    continue
+                if not record:
+                    continue
+                editions.append((offset, record))
+                for key in record.authors:
+                    for author_offset in find_author(index, key):
+                        author_offsets[author_offset] = key
+
+        authors: dict[str, AuthorRecord] = {}
+        for offset in sorted(author_offsets.keys()):
+            line = read_line(context, data_stream, offset)
+            # Different keys can share a hash, only keep the exact match
+            if line.split("\t")[1] != author_offsets[offset]:
+                continue
+            record = parser.parse_line(line)
+            if record:
+                authors[record.key] = record
+
+    for record in authors.values():
+        write_author(context, record)
+
+    for count, (_, record) in enumerate(sorted(editions, key=lambda e: e[0])):
+        write_edition(context, record)
+        progress.update(task, completed=count + 1)
+
+
+def read_line(context: GeneratorContext, data_stream, offset: int) -> str:
+    data_stream.seek(offset)
+    line = data_stream.readline()
+    context.metrics.dump_read(len(line))
+    return line.decode("utf-8").strip(" \n")
+
+
+def ingest_parallel(context: GeneratorContext, progress: Progress, task) -> Counter:
+    position = context.checkpoint.position("download_books", {"offset": 0, "count": 0})
+    count = position["count"]
+    read = position["offset"]
+    # Zeroed date stats, so the summary works even if no chunk is processed
+    stats = RecordParser(
+        context.options["date_cache_size"], context.options["json_decoder"]
+    ).stats()
+    with ProcessPoolExecutor(max_workers=context.options["data_workers"]) as pool:
+        pending: deque[tuple[Future, int]] = deque()
+
+        # Keep a bounded window of chunks in flight and consume them in file
+        # order, so IDs and genre/publisher dedup match the serial path
+        for job, consumed in parse_jobs(context, pool, position["offset"]):
+            pending.append((job, consumed))
+            if len(pending) < context.options["data_workers"] * 2:
+                continue
+            job, consumed = pending.popleft()
+            result = job.result()
+            stats.update(result.stats)
+            count = write_chunk(context, result, count, progress, task, consumed)
+            context.metrics.dump_read(consumed - read)
+            read = consumed
+            if context.options["data_limit"] and count > context.options["data_limit"]:
+                break
+
+        while len(pending) > 0 and not (
+            context.options["data_limit"] and count > context.options["data_limit"]
+        ):
+            job, consumed = pending.popleft()
+            result = job.result()
+            stats.update(result.stats)
+            count = write_chunk(context, result, count, progress, task, consumed)
+            context.metrics.dump_read(consumed - read)
+            read = consumed
+
+        for job, consumed in pending:
+            job.cancel()
+
+    return stats
+
+
+def parse_jobs(
+    context: GeneratorContext, pool: ProcessPoolExecutor, offset: int
+) -> Iterator[tuple[Future, int]]:
+    path = context.options["data_path"]
+    if not is_compressed(path):
+        # Workers read their own byte ranges straight from disk
+        for start, end in split_ranges(path, context.options["data_chunk"], offset):
+            yield pool.submit(
+                parse_chunk, path, start, end, parser_options(context)
+            ), end
+        return
+
+    with DumpReader(path, context.options["data_chunk"], offset) as reader:
+        for block in reader:
+            yield pool.submit(
+                parse_block, block.data, block.offset, parser_options(context)
+            ), block.consumed
+
+
+def write_chunk(
+    context: GeneratorContext,
+    result: ChunkResult,
+    count: int,
+    progress: Progress,
+    task,
+    consumed: int,
+) -> int:
+    for dstring in result.errors:
+        print_parse_error(progress.console, dstring)
+
+    for record in result.records:
+        write_record(context, record)
+        count += 1
+        if context.options["data_limit"] and count > context.options["data_limit"]:
+            break
+
+    if context.options["data_limit"]:
+        progress.update(task, completed=count)
+    else:
+        progress.update(task, completed=consumed)
+    progress.refresh()
+    context.checkpoint.tick("download_books", {"offset": result.end, "count": count})
+    return count
+
+
+def split_ranges(path: str, chunk: int, start: int = 0) -> Iterator[tuple[int, int]]:
+    size = os.stat(path).st_size
+    with open(path, "rb") as data_stream:
+        while start < size:
+            data_stream.seek(min(start + chunk, size))
+            data_stream.readline()
+            end = min(data_stream.tell(), size)
+            yield start, end
+            start = end
+
+
+def parser_options(context: GeneratorContext) -> tuple[int, str]:
+    return context.options["date_cache_size"], context.options["json_decoder"]
+
+
+def parse_chunk(
+    path: str, start: int, end: int, options: tuple[int, str]
+) -> ChunkResult:
+    with open(path, "rb") as data_stream:
+        data_stream.seek(start)
+        data = data_stream.read(end - start)
+    return parse_block(filter_records(data), end, options)
+
+
+def parse_block(data: bytes, end: int, options: tuple[int, str]) -> ChunkResult:
+    # The parser (and its date cache) lives for the whole life of the worker
+    global worker_parser
+    if not worker_parser:
+        worker_parser = RecordParser(*options)
+    before = worker_parser.stats()
+
+    records = []
+    errors = []
+    for line in data.decode("utf-8").split("\n"):
+        line = line.strip(" \n")
+        if len(line) == 0:
+            continue
+        try:
+            record = worker_parser.parse_line(line)
+        except PublishDateError as e:
+            errors.append(str(e))
+            continue
+        if record:
+            records.append(record)
+
+    stats = worker_parser.stats()
+    stats.subtract(before)
+    return ChunkResult(records, errors, end, stats)
+
+
+def register_statements(context: GeneratorContext):
+    context.register(
+        "contributors",
+        "INSERT INTO "
+        + context.table("contributors")
+        + " (id, name_first, name_last_company) VALUES (:id, :first_name, :last_name) ON CONFLICT DO NOTHING",
+    )
+    context.register(
+        "books",
         "INSERT INTO "
         + context.table("books")
         + " (id, title, length, edition, release_dt, isbn) VALUES (:id, :title, :length, :edition, :release_dt, :isbn) ON CONFLICT DO NOTHING",
-        dict(
-            id=mapped_id,
-            title=trimmed["title"].replace("'", "\\'"),
-            length=trimmed["number_of_pages"],
-            edition=trimmed["edition_name"],
-            release_dt=datetime.datetime.fromtimestamp(parsed_dt).isoformat(),
-            isbn=int(trimmed["isbn_13"][0]),
-        ),
     )
-    context.create_mapped("editions", id, mapped_id)
+    context.register(
+        "genres",
+        "INSERT INTO "
+        + context.table("genres")
+        + " (id, name) VALUES (:id, :name) ON CONFLICT DO NOTHING",
+    )
+    context.register(
+        "books.genres",
+        "INSERT INTO "
+        + context.table("books.genres")
+        + " (book_id, genre_id) VALUES (:bid, :gid) ON CONFLICT DO NOTHING",
+    )
+    context.register(
+        "publishers",
+        "INSERT INTO "
+        + context.table("contributors")
+        + " (id, name_first, name_last_company) VALUES (:id, NULL, :name) ON CONFLICT DO NOTHING",
+    )
+    context.register(
+        "books.publishers",
+        "INSERT INTO "
+        + context.table("books.publishers")
+        + " (book_id, contributor_id) VALUES (:bid, :pid) ON CONFLICT DO NOTHING",
+    )
+    context.register(
+        "books.authors",
+        "INSERT INTO "
+        + context.table("books.authors")
+        + " (book_id, contributor_id) VALUES (:bid, :cid) ON CONFLICT DO NOTHING",
+    )
+    context.register(
+        "books.editors",
+        "INSERT INTO "
+        + context.table("books.editors")
+        + " (book_id, contributor_id) VALUES (:bid, :cid) ON CONFLICT DO NOTHING",
+    )
+
+
+def write_author(context: GeneratorContext, record: AuthorRecord):
+    mapped_id = context.id("contributors")
+    context.statements["contributors"].add(
+        mapped_id, record.first_name, record.last_name
+    )
+    context.create_mapped("contributors", record.key, mapped_id)
+    if context.resolver:
+        for book_id in context.resolver.author(record.key, mapped_id):
+            link_author(context, book_id, mapped_id)
+
+
+def write_edition(context: GeneratorContext, record: EditionRecord):
+    mapped_id = context.id("editions")
+
+    context.statements["books"].add(
+        mapped_id,
+        record.title,
+        record.length,
+        record.edition,
+        datetime.datetime.fromtimestamp(record.release),
+        record.isbn,
+    )
+    context.create_mapped("editions", record.key, mapped_id)
 
-    context.atomics["pages"][mapped_id] = trimmed["number_of_pages"]
+    context.atomics.pages[mapped_id] = record.length
 
-    for g in trimmed.get("genres", []):
-        normal = g.lower().replace("-", "").replace(".", "")
-        if not normal in context.atomics["genre"].keys():
+    for normal in record.genres:
+        genre_id = context.atomics.genre.get(normal)
+        if genre_id is None:
             genre_id = context.id("genres")
-            context.execute_cached(
-                "INSERT INTO "
-                + context.table("genres")
-                + " (id, name) VALUES (:id, :name) ON CONFLICT DO NOTHING",
-                {"id": genre_id, "name": normal[:25]},
-            )
-            context.atomics["genre"][normal] = genre_id
-        else:
-            genre_id = context.atomics["genre"][normal]
+            context.statements["genres"].add(genre_id, normal[:25])
+            context.atomics.genre[normal] = genre_id
 
-        context.execute_cached(
-            "INSERT INTO "
-            + context.table("books.genres")
-            + " (book_id, genre_id) VALUES (:bid, :gid) ON CONFLICT DO NOTHING",
-            {"bid": mapped_id, "gid": genre_id},
-        )
+        context.statements["books.genres"].add(mapped_id, genre_id)
 
-    for p in trimmed.get("publishers", []):
-        normal = p.lower()
-        if not normal in context.atomics["publisher"].keys():
+    for normal in record.publishers:
+        pub_id = context.atomics.publisher.get(normal)
+        if pub_id is None:
             pub_id = context.id("contributors")
-            context.execute_cached(
-                "INSERT INTO "
-                + context.table("contributors")
-                + " (id, name_first, name_last_company) VALUES (:id, NULL, :name) ON CONFLICT DO NOTHING",
-                {"id": pub_id, "name": normal[:50]},
-            )
-            context.atomics["publisher"][normal] = pub_id
-        else:
-            pub_id = context.atomics["publisher"][normal]
+            context.statements["publishers"].add(pub_id, normal[:50])
+            context.atomics.publisher[normal] = pub_id
 
-        context.execute_cached(
-            "INSERT INTO "
-            + context.table("books.publishers")
-            + " (book_id, contributor_id) VALUES (:bid, :pid) ON CONFLICT DO NOTHING",
-            {"bid": mapped_id, "pid": pub_id},
-        )
+        context.statements["books.publishers"].add(mapped_id, pub_id)
 
-    for a in trimmed["authors"]:
-        if "key" in a.keys():
-            context.stage_author(mapped_id, a["key"])
+    if context.resolver:
+        for contributor_id in context.resolver.edition(mapped_id, record.authors):
+            link_author(context, mapped_id, contributor_id)
+    else:
+        for key in record.authors:
+            context.stage_author(mapped_id, key)
 
-    return True
 
+def link_author(context: GeneratorContext, book_id: int, contributor_id: int):
+    context.statements["books.authors"].add(book_id, contributor_id)
+    # Same editor assignment as the staging JOIN in link_books
+    if contributor_id % 5 == 0:
+        context.statements["books.editors"].add(book_id, contributor_id)
 
-def process_line(context: GeneratorContext, line: str, console: Console) -> bool:
-    parts = line.split("\t")
-    record_type = parts[0]
-    record_id = parts[1]
-    record_data = json.loads(parts[4])
 
-    if record_type == "/type/author":
-        return store_author(record_id, record_data, context, console)
-    if record_type == "/type/edition":
-        return store_edition(record_id, record_data, context, console)
+def print_parse_error(console: Console, dstring: str):
+    console.print(
+        "\t[red][bold]Parse Error:[/bold] Parsing date string {dstring}[/red]".format(
+            dstring=dstring
+        )
+    )
 
-    return False
+
+def write_record(
+    context: GeneratorContext, record: Union[AuthorRecord, EditionRecord]
+):
+    if isinstance(record, AuthorRecord):
+        write_author(context, record)
+    else:
+        write_edition(context, record)
+
+
+def process_line(
+    context: GeneratorContext, line: str, console: Console, parser: RecordParser
+) -> bool:
+    try:
+        record = parser.parse_line(line)
+    except PublishDateError as e:
+        print_parse_error(console, str(e))
+        return False
+    if not record:
+        return False
+    write_record(context, record)
+    return True
@@ -6,19 +6,24 @@ import random
 
 def store_audiences(context: GeneratorContext):
     print("\tStoring audiences in DB...")
-    context.db.cursor().executemany(
+    audiences = context.register(
+        "audiences",
         "INSERT INTO "
         + context.table("audiences")
-        + " (id, name) VALUES (%(id)s, %(name)s)",
-        [
-            {"id": context.options["audiences"].index(a), "name": a}
-            for a in context.options["audiences"]
-        ],
+        + " (id, name) VALUES (:id, :name) ON CONFLICT DO NOTHING",
     )
-    context.db.commit()
+    for a in context.options["audiences"]:
+        audiences.add(context.options["audiences"].index(a), a)
+    context.clean_cache()
 
 
 def link_audiences(context: GeneratorContext):
+    books_audiences = context.register(
+        "books.audiences",
+        "INSERT INTO "
+        + context.table("books.audiences")
+        + " (book_id, audience_id) VALUES (:bid, :aid) ON CONFLICT DO NOTHING",
+    )
     for book_id in track(
         range(context.ids["editions"]), description="\tAssigning audiences to books..."
     ):
@@ -26,12 +31,7 @@ def link_audiences(context: GeneratorContext):
         random.shuffle(to_select)
         to_select = to_select[: random.randint(1, context.options["max_audiences"])]
         for audience in to_select:
-            context.execute_cached(
-                "INSERT INTO "
-                + context.table("books.audiences")
-                + " (book_id, audience_id) VALUES (:bid, :aid) ON CONFLICT DO NOTHING",
-                {"bid": book_id, "aid": context.options["audiences"].index(audience)},
-            )
+            books_audiences.add(book_id, context.options["audiences"].index(audience))
 
 
 def link_books_main(context: GeneratorContext):
@@ -39,31 +39,39 @@ def link_books_main(context: GeneratorContext):
     store_audiences(context)
     link_audiences(context)
 
-    print("\tLinking authors...")
-    context.db.execute(
-        "INSERT INTO {books_authors} (book_id, contributor_id) SELECT book_id, mapped from (SELECT * FROM staging_books_authors_mapping INNER JOIN staging_id_mapping ON author_raw=original) as superquery".format(
-            books_authors=context.table("books.authors")
+    if context.options["author_resolver"] == "staging":
+        print("\tLinking authors...")
+        context.execute(
+            "INSERT INTO {books_authors} (book_id, contributor_id) SELECT book_id, mapped from (SELECT * FROM staging_books_authors_mapping INNER JOIN staging_id_mapping ON author_raw=original) as superquery ON CONFLICT DO NOTHING".format(
+                books_authors=context.table("books.authors")
+            )
         )
-    )
 
-    print("\tLinking editors...")
-    context.db.execute(
-        "INSERT INTO {books_editors} (book_id, contributor_id) SELECT book_id, mapped from (SELECT * FROM staging_books_authors_mapping INNER JOIN staging_id_mapping ON author_raw=original) as superquery WHERE MOD(mapped, 5) = 0".format(
-            books_editors=context.table("books.editors")
+        print("\tLinking editors...")
+        context.execute(
+            "INSERT INTO {books_editors} (book_id, contributor_id) SELECT book_id, mapped from (SELECT * FROM staging_books_authors_mapping INNER JOIN staging_id_mapping ON author_raw=original) as superquery WHERE MOD(mapped, 5) = 0 ON CONFLICT DO NOTHING".format(
+                books_editors=context.table("books.editors")
+            )
         )
-    )
-    
+    else:
+        # Author links were written during download_books
+        print(
+            "\t[grey70 italic]{count} editions had no known author[/grey70 italic]".format(
+                count=context.resolver.unresolved()
+            )
+        )
+
     print("\tTrimming books...")
-    context.db.execute(
+    context.execute(
         "DELETE FROM {books} WHERE id NOT IN (SELECT book_id FROM books_authors)".format(
             books=context.table("books")
         )
     )
 
     print("\tTrimming contributors...")
-    context.db.execute(
+    context.execute(
         "DELETE FROM {contributors} WHERE id NOT IN (SELECT contributor_id FROM books_authors) AND name_first IS NOT NULL".format(
             contributors=context.table("contributors")
         )
     )
-    context.db.commit()
+    context.commit()
@@ -1,5 +1,5 @@
-from markov_word_generator import MarkovWordGenerator
 from util import GeneratorContext
+from markov import generate_words
 from rich import print
 from rich.progress import track
 from rich.console import Console
@@ -7,27 +7,41 @@ import time
 import random
 import datetime
 
+# Users whose names and passwords are generated in one call
+USER_BATCH = 4096
+
 
 def make_users_main(context: GeneratorContext):
     console = Console()
     print("[green][bold]STEP: [/bold] Generating user data...[/green]")
-    markov_names = MarkovWordGenerator(
-        markov_length=4, dictionary_filename=context.options["names_dict"]
-    )
-    markov_passwords = MarkovWordGenerator(
-        markov_length=2, dictionary_filename=context.options["words_dict"]
-    )
+    markov_names = context.get_markov("names", 4)
+    markov_passwords = context.get_markov("words", 2)
 
-    for _ in track(
-        range(context.options["user_count"]), description="\tCreating users...", console=console
+    users = context.register(
+        "users",
+        "INSERT INTO "
+        + context.table("users")
+        + " (id, creation_dt, access_dt, name_first, name_last, email, password) VALUES (:id, :creation, :access, :first, :last, :email, :password) ON CONFLICT DO NOTHING",
+    )
+    start = context.checkpoint.position("make_users", 0)
+    names: list[str] = []
+    words: list[str] = []
+    for index in track(
+        range(start, context.options["user_count"]),
+        description="\tCreating users...",
+        console=console,
     ):
-        first_name = markov_names.generate_word()[: context.options["max_name"]]
-        last_name = markov_names.generate_word()[: context.options["max_name"]]
+        if len(names) == 0:
+            batch = min(USER_BATCH, context.options["user_count"] - index)
+            names = generate_words(markov_names, batch * 2, context.options["max_name"])
+            words = generate_words(markov_passwords, batch * 3)
+        first_name = names.pop()
+        last_name = names.pop()
         email = (first_name + "_" + last_name)[
             : context.options["max_email"] - 10
         ] + "@gmail.com"
         password = (
-            "-".join([markov_passwords.generate_word() for _ in range(3)])
+            "-".join([words.pop() for _ in range(3)])
             .title()
             .swapcase()
             .replace("S", "$")
@@ -36,19 +50,15 @@ def make_users_main(context: GeneratorContext):
         creation_time = random.randint(0, int(time.time()) - 100000)
         access_time = random.randint(creation_time, int(time.time()))
         internal_id = context.id("users")
-        context.execute_cached(
-            "INSERT INTO "
-            + context.table("users")
-            + " (id, creation_dt, access_dt, name_first, name_last, email, password) VALUES (:id, :creation, :access, :first, :last, :email, :password) ON CONFLICT DO NOTHING",
-            {
-                "id": internal_id,
-                "creation": datetime.datetime.fromtimestamp(creation_time).isoformat(),
-                "access": datetime.datetime.fromtimestamp(access_time).isoformat(),
-                "first": first_name,
-                "last": last_name,
-                "email": email,
-                "password": password,
-            },
+        users.add(
+            internal_id,
+            datetime.datetime.fromtimestamp(creation_time),
+            datetime.datetime.fromtimestamp(access_time),
+            first_name,
+            last_name,
+            email,
+            password,
         )
+        context.checkpoint.tick("make_users", index + 1)
 
     context.clean_cache()
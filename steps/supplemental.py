@@ -1,18 +1,48 @@
+from typing import Callable
 from util import GeneratorContext
+from popularity import relationship_popularity
 from rich import print
 from rich.progress import track
+import steps.supplemental_numpy as numpy_engine
+import steps.supplemental_sharded as sharded_engine
 import random
-from markov_word_generator import MarkovWordGenerator
 import time
 import datetime
 
 
+def picker(context: GeneratorContext, relationship: str, entity: str) -> Callable[[], int]:
+    table = relationship_popularity(
+        context, relationship, entity, random.getrandbits(64)
+    )
+    if table is None:
+        return lambda: random.randint(0, context.ids[entity])
+    return lambda: table.sample(random.random(), random.random())
+
+
 def build_collections(context: GeneratorContext):
-    markov = MarkovWordGenerator(
-        markov_length=4, dictionary_filename=context.options["words_dict"]
+    pick_book = picker(context, "collections", "editions")
+    markov = context.get_markov("words", 4)
+    collections = context.register(
+        "collections",
+        "INSERT INTO "
+        + context.table("collections")
+        + " (id, name) VALUES (:id, :name) ON CONFLICT DO NOTHING",
+    )
+    users_collections = context.register(
+        "users.collections",
+        "INSERT INTO "
+        + context.table("users.collections")
+        + " (user_id, collection_id) VALUES (:uid, :cid) ON CONFLICT DO NOTHING",
     )
+    books_collections = context.register(
+        "books.collections",
+        "INSERT INTO "
+        + context.table("books.collections")
+        + " (book_id, collection_id) VALUES (:bid, :cid) ON CONFLICT DO NOTHING",
+    )
+    start = context.checkpoint.position("supplemental.build_collections", 0)
     for user_id in track(
-        range(context.options["user_count"]), "\tCreating user collections..."
+        range(start, context.options["user_count"]), "\tCreating user collections..."
     ):
         for collection_count in range(
             random.randint(0, context.options["max_collections"])
@@ -21,23 +51,13 @@ def build_collections(context: GeneratorContext):
                 [markov.generate_word() for l in range(2)]
             ).title()[: context.options["max_collection_name"]]
             collection_id = context.id("collections")
-            context.execute_cached(
-                "INSERT INTO "
-                + context.table("collections")
-                + " (id, name) VALUES (:id, :name)",
-                {"id": collection_id, "name": collection_name},
-            )
-            context.execute_cached(
-                "INSERT INTO "
-                + context.table("users.collections")
-                + " (user_id, collection_id) VALUES (:uid, :cid)",
-                {"uid": user_id, "cid": collection_id},
-            )
+            collections.add(collection_id, collection_name)
+            users_collections.add(user_id, collection_id)
 
             book_ids = list(
                 set(
                     [
-                        random.randint(0, context.ids["editions"])
+                        pick_book()
                         for i in range(
                             random.randint(1, context.options["max_collection_size"])
                         )
@@ -46,63 +66,77 @@ def build_collections(context: GeneratorContext):
             )
 
             for bid in book_ids:
-                context.execute_cached(
-                    "INSERT INTO "
-                    + context.table("books.collections")
-                    + " (book_id, collection_id) VALUES (:bid, :cid)",
-                    {"bid": bid, "cid": collection_id},
-                )
+                books_collections.add(bid, collection_id)
+        context.checkpoint.tick("supplemental.build_collections", user_id + 1)
 
     context.clean_cache()
 
 
 def make_friends(context: GeneratorContext):
-    for follower in track(range(context.ids["users"]), "\tMaking friends..."):
+    pick_user = picker(context, "following", "users")
+    following = context.register(
+        "users.following",
+        "INSERT INTO "
+        + context.table("users.following")
+        + " (user_id, following_id) VALUES (:uid, :fid) ON CONFLICT DO NOTHING",
+    )
+    start = context.checkpoint.position("supplemental.make_friends", 0)
+    for follower in track(range(start, context.ids["users"]), "\tMaking friends..."):
         to_follow = list(
             set(
                 [
-                    random.randint(0, context.ids["users"])
+                    pick_user()
                     for _ in range(random.randint(1, context.options["max_following"]))
                 ]
             )
         )
         for followee in to_follow:
             if followee != follower:
-                context.execute_cached(
-                    "INSERT INTO "
-                    + context.table("users.following")
-                    + " (user_id, following_id) VALUES (:uid, :fid)",
-                    {"uid": follower, "fid": followee},
-                )
+                following.add(follower, followee)
+        context.checkpoint.tick("supplemental.make_friends", follower + 1)
     context.clean_cache()
 
 
 def rate_books(context: GeneratorContext):
-    for book in track(range(context.ids["editions"]), "\tRating books..."):
+    pick_user = picker(context, "ratings", "users")
+    ratings = context.register(
+        "users.ratings",
+        "INSERT INTO "
+        + context.table("users.ratings")
+        + " (book_id, user_id, rating) VALUES (:bid, :uid, :rating) ON CONFLICT DO NOTHING",
+    )
+    start = context.checkpoint.position("supplemental.rate_books", 0)
+    for book in track(range(start, context.ids["editions"]), "\tRating books..."):
         users = list(
             set(
                 [
-                    random.randint(0, context.ids["users"])
+                    pick_user()
                     for i in range(random.randint(0, context.options["max_ratings"]))
                 ]
             )
         )
         for user_id in users:
-            context.execute_cached(
-                "INSERT INTO "
-                + context.table("users.ratings")
-                + " (book_id, user_id, rating) VALUES (:bid, :uid, :rating)",
-                {"bid": book, "uid": user_id, "rating": random.randint(0, 5)},
-            )
+            ratings.add(book, user_id, random.randint(0, 5))
+        context.checkpoint.tick("supplemental.rate_books", book + 1)
     context.clean_cache()
 
 
 def read_books(context: GeneratorContext):
-    for user_id in track(range(context.ids["users"]), "\tAcquiring an education..."):
+    pick_book = picker(context, "sessions", "editions")
+    sessions = context.register(
+        "users.sessions",
+        "INSERT INTO "
+        + context.table("users.sessions")
+        + " (session_id, book_id, user_id, start_datetime, end_datetime, start_page, end_page) VALUES (:sid, :bid, :uid, :sdt, :edt, :sp, :ep) ON CONFLICT DO NOTHING",
+    )
+    start = context.checkpoint.position("supplemental.read_books", 0)
+    for user_id in track(
+        range(start, context.ids["users"]), "\tAcquiring an education..."
+    ):
         to_read = list(
             set(
                 [
-                    random.randint(0, context.ids["editions"])
+                    pick_book()
                     for i in range(random.randint(0, context.options["max_sessions"]))
                 ]
             )
@@ -116,29 +150,49 @@ def read_books(context: GeneratorContext):
                 (context.options["max_session_time"] * 3600) // 100,
                 context.options["max_session_time"] * 3600,
             )
-            start_page = random.randint(0, context.atomics["pages"][book])
-            end_page = random.randint(start_page, context.atomics["pages"][book])
+            start_page = random.randint(0, context.atomics.pages[book])
+            end_page = random.randint(start_page, context.atomics.pages[book])
             session_id = context.id("sessions")
-            context.execute_cached(
-                "INSERT INTO "
-                + context.table("users.sessions")
-                + " (session_id, book_id, user_id, start_datetime, end_datetime, start_page, end_page) VALUES (:sid, :bid, :uid, :sdt, :edt, :sp, :ep) ON CONFLICT DO NOTHING",
-                {
-                    "sid": session_id,
-                    "bid": book,
-                    "uid": user_id,
-                    "sdt": datetime.datetime.fromtimestamp(start_dt).isoformat(),
-                    "edt": datetime.datetime.fromtimestamp(end_dt).isoformat(),
-                    "sp": start_page,
-                    "ep": end_page
-                },
+            sessions.add(
+                session_id,
+                book,
+                user_id,
+                datetime.datetime.fromtimestamp(start_dt),
+                datetime.datetime.fromtimestamp(end_dt),
+                start_page,
+                end_page,
             )
+        context.checkpoint.tick("supplemental.read_books", user_id + 1)
     context.clean_cache()
 
 
 def supplemental_main(context: GeneratorContext):
     print("[green][bold]STEP: [/bold] Performing supplemental tasks...[/green]")
-    build_collections(context)
-    make_friends(context)
-    rate_books(context)
-    read_books(context)
+    engines = {
+        "python": [build_collections, make_friends, rate_books, read_books],
+        "numpy": [
+            numpy_engine.build_collections,
+            numpy_engine.make_friends,
+            numpy_engine.rate_books,
+            numpy_engine.read_books,
+        ],
+        "sharded": [
+            sharded_engine.build_collections,
+            sharded_engine.make_friends,
+            sharded_engine.rate_books,
+            sharded_engine.read_books,
+        ],
+    }
+    for name, task in zip(
+        [
+            "supplemental.build_collections",
+            "supplemental.make_friends",
+            "supplemental.rate_books",
+            "supplemental.read_books",
+        ],
+        engines[context.options["supplemental_engine"]],
+    ):
+        if not context.checkpoint.done(name):
+            with context.metrics.step(name):
+                task(context)
+            context.checkpoint.complete(name)
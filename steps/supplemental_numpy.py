@@ -0,0 +1,200 @@
+from util import GeneratorContext
+from markov import generate_words
+from popularity import relationship_popularity
+from rich.progress import track
+from typing import Union
+import random
+import time
+import datetime
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def make_rng(source: Union[random.Random, None] = None):
+    if np is None:
+        raise ImportError("SUPPLEMENTAL_ENGINE = numpy requires the numpy package")
+    return np.random.default_rng((source or random).getrandbits(64))
+
+
+def chunks(context: GeneratorContext, step: str, end: int, description: str):
+    start = context.checkpoint.position(step, 0)
+    size = context.options["supplemental_chunk"]
+    for lo in track(range(start, end, size), description):
+        yield lo, min(lo + size, end)
+        context.checkpoint.tick(step, min(lo + size, end))
+
+
+def draw(rng, owners, counts, high: int, popularity=None):
+    """
+    `counts[i]` values in [0, high] for each of `owners`, as (owner, value)
+    pairs without duplicates, sorted by owner. Values are uniform unless a
+    popularity AliasTable is given.
+    """
+    owner = np.repeat(owners, counts)
+    if popularity is None:
+        value = rng.integers(0, high + 1, size=len(owner))
+    else:
+        value = popularity.pick(rng.random(len(owner)), rng.random(len(owner)))
+    keys = np.unique(owner * (high + 1) + value)
+    return keys // (high + 1), keys % (high + 1)
+
+
+def build_collections(
+    context: GeneratorContext, source: Union[random.Random, None] = None
+):
+    rng = make_rng(source)
+    popularity = relationship_popularity(
+        context, "collections", "editions", (source or random).getrandbits(64)
+    )
+    markov = context.get_markov("words", 4, source)
+    collections = context.register(
+        "collections",
+        "INSERT INTO "
+        + context.table("collections")
+        + " (id, name) VALUES (:id, :name) ON CONFLICT DO NOTHING",
+    )
+    users_collections = context.register(
+        "users.collections",
+        "INSERT INTO "
+        + context.table("users.collections")
+        + " (user_id, collection_id) VALUES (:uid, :cid) ON CONFLICT DO NOTHING",
+    )
+    books_collections = context.register(
+        "books.collections",
+        "INSERT INTO "
+        + context.table("books.collections")
+        + " (book_id, collection_id) VALUES (:bid, :cid) ON CONFLICT DO NOTHING",
+    )
+    for lo, hi in chunks(
+        context,
+        "supplemental.build_collections",
+        context.options["user_count"],
+        "\tCreating user collections...",
+    ):
+        users = np.arange(lo, hi)
+        owned = rng.integers(0, context.options["max_collections"] + 1, size=len(users))
+        count = int(owned.sum())
+        if count == 0:
+            continue
+        ids = np.arange(count) + context.id_range("collections", count)
+        words = generate_words(markov, count * 2)
+        names = [
+            (words[i * 2] + " " + words[i * 2 + 1]).title()[
+                : context.options["max_collection_name"]
+            ]
+            for i in range(count)
+        ]
+        collections.extend(list(zip(ids.tolist(), names)))
+        users_collections.extend(
+            list(zip(np.repeat(users, owned).tolist(), ids.tolist()))
+        )
+
+        sizes = rng.integers(
+            1, context.options["max_collection_size"] + 1, size=count
+        )
+        collection, book = draw(rng, ids, sizes, context.ids["editions"], popularity)
+        books_collections.extend(list(zip(book.tolist(), collection.tolist())))
+
+    context.clean_cache()
+
+
+def make_friends(context: GeneratorContext):
+    rng = make_rng()
+    popularity = relationship_popularity(
+        context, "following", "users", random.getrandbits(64)
+    )
+    following = context.register(
+        "users.following",
+        "INSERT INTO "
+        + context.table("users.following")
+        + " (user_id, following_id) VALUES (:uid, :fid) ON CONFLICT DO NOTHING",
+    )
+    for lo, hi in chunks(
+        context, "supplemental.make_friends", context.ids["users"], "\tMaking friends..."
+    ):
+        followers = np.arange(lo, hi)
+        counts = rng.integers(
+            1, context.options["max_following"] + 1, size=len(followers)
+        )
+        follower, followee = draw(
+            rng, followers, counts, context.ids["users"], popularity
+        )
+        keep = follower != followee
+        following.extend(
+            list(zip(follower[keep].tolist(), followee[keep].tolist()))
+        )
+    context.clean_cache()
+
+
+def rate_books(context: GeneratorContext):
+    rng = make_rng()
+    popularity = relationship_popularity(
+        context, "ratings", "users", random.getrandbits(64)
+    )
+    ratings = context.register(
+        "users.ratings",
+        "INSERT INTO "
+        + context.table("users.ratings")
+        + " (book_id, user_id, rating) VALUES (:bid, :uid, :rating) ON CONFLICT DO NOTHING",
+    )
+    for lo, hi in chunks(
+        context, "supplemental.rate_books", context.ids["editions"], "\tRating books..."
+    ):
+        books = np.arange(lo, hi)
+        counts = rng.integers(0, context.options["max_ratings"] + 1, size=len(books))
+        book, user = draw(rng, books, counts, context.ids["users"], popularity)
+        rating = rng.integers(0, 6, size=len(book))
+        ratings.extend(list(zip(book.tolist(), user.tolist(), rating.tolist())))
+    context.clean_cache()
+
+
+def read_books(context: GeneratorContext):
+    rng = make_rng()
+    popularity = relationship_popularity(
+        context, "sessions", "editions", random.getrandbits(64)
+    )
+    sessions = context.register(
+        "users.sessions",
+        "INSERT INTO "
+        + context.table("users.sessions")
+        + " (session_id, book_id, user_id, start_datetime, end_datetime, start_page, end_page) VALUES (:sid, :bid, :uid, :sdt, :edt, :sp, :ep) ON CONFLICT DO NOTHING",
+    )
+    pages = np.frombuffer(context.atomics.pages.pages, dtype=np.uint64)
+    session_time = context.options["max_session_time"] * 3600
+    for lo, hi in chunks(
+        context,
+        "supplemental.read_books",
+        context.ids["users"],
+        "\tAcquiring an education...",
+    ):
+        users = np.arange(lo, hi)
+        counts = rng.integers(0, context.options["max_sessions"] + 1, size=len(users))
+        user, book = draw(rng, users, counts, context.ids["editions"], popularity)
+        count = len(user)
+        if count == 0:
+            continue
+        start_dt = rng.integers(0, int(time.time() - session_time) + 1, size=count)
+        end_dt = start_dt + rng.integers(
+            session_time // 100, session_time + 1, size=count
+        )
+        length = pages[book].astype(np.int64)
+        start_page = rng.integers(0, length + 1)
+        end_page = rng.integers(start_page, length + 1)
+        ids = np.arange(count) + context.id_range("sessions", count)
+        sessions.extend(
+            list(
+                zip(
+                    ids.tolist(),
+                    book.tolist(),
+                    user.tolist(),
+                    map(datetime.datetime.fromtimestamp, start_dt.tolist()),
+                    map(datetime.datetime.fromtimestamp, end_dt.tolist()),
+                    start_page.tolist(),
+                    end_page.tolist(),
+                )
+            )
+        )
+    context.clean_cache()
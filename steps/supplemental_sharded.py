@@ -0,0 +1,307 @@
+from typing import Callable, Iterator, Union
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, Future
+from dataclasses import dataclass
+from util import GeneratorContext
+from popularity import AliasTable, relationship_popularity
+from rich.progress import track
+import steps.supplemental_numpy as numpy_engine
+import random
+import time
+import datetime
+
+try:
+    import numpy as np
+    import counter_rng
+except ImportError:
+    np = None
+
+# Popularity tables by relationship, sent to each worker once on startup
+POPULARITY: dict[str, AliasTable] = {}
+
+# Sessions end before this when DATA_SEED is set without SUPPLEMENTAL_EPOCH,
+# so seeded runs don't depend on the day they run
+SEEDED_EPOCH = 1700000000
+
+
+def set_popularity(tables: dict[str, AliasTable]):
+    global POPULARITY
+    POPULARITY = tables
+
+
+@dataclass
+class ShardOptions:
+    """Everything a shard needs, so workers don't need the context."""
+
+    seed: int
+    users: int
+    editions: int
+    max_following: int
+    max_ratings: int
+    max_sessions: int
+    session_time: int
+    epoch: int
+
+
+def shard_options(context: GeneratorContext) -> ShardOptions:
+    if np is None:
+        raise ImportError("SUPPLEMENTAL_ENGINE = sharded requires the numpy package")
+    return ShardOptions(
+        seed=context.options["data_seed"] or 0,
+        users=context.ids["users"],
+        editions=context.ids["editions"],
+        max_following=context.options["max_following"],
+        max_ratings=context.options["max_ratings"],
+        max_sessions=context.options["max_sessions"],
+        session_time=context.options["max_session_time"] * 3600,
+        epoch=session_epoch(context),
+    )
+
+
+def session_epoch(context: GeneratorContext) -> int:
+    if context.options["supplemental_epoch"] is not None:
+        return context.options["supplemental_epoch"]
+    epoch = context.checkpoint.position("supplemental.epoch")
+    if epoch is None:
+        if context.options["data_seed"] is not None:
+            epoch = SEEDED_EPOCH
+        else:
+            epoch = int(time.time())
+        # Shards generated after a resume have to use the same epoch
+        context.checkpoint.save("supplemental.epoch", epoch)
+    return epoch
+
+
+def draw(
+    seed: int,
+    table: str,
+    lo: int,
+    hi: int,
+    low: int,
+    most: int,
+    high: int,
+    popularity: Union[AliasTable, None],
+):
+    """
+    Between `low` and `most` values in [0, high] for each owner in [lo, hi),
+    as sorted (owner, value) pairs without duplicates. The j-th value of an
+    owner only depends on (seed, table, owner, j).
+    """
+    owners = np.arange(lo, hi)
+    counts = counter_rng.integers(
+        counter_rng.stream(seed, table, "count"), owners, 0, low, most
+    )
+    owner = np.repeat(owners, counts)
+    draws = np.arange(len(owner)) - np.repeat(np.cumsum(counts) - counts, counts)
+    if popularity is None:
+        value = counter_rng.integers(
+            counter_rng.stream(seed, table, "value"), owner, draws, 0, high
+        )
+    else:
+        value = popularity.pick(
+            counter_rng.uniform(counter_rng.stream(seed, table, "value"), owner, draws),
+            counter_rng.uniform(counter_rng.stream(seed, table, "alias"), owner, draws),
+        )
+    keys = np.unique(owner * (high + 1) + value)
+    return keys // (high + 1), keys % (high + 1)
+
+
+def follows_shard(options: ShardOptions, lo: int, hi: int):
+    follower, followee = draw(
+        options.seed,
+        "users.following",
+        lo,
+        hi,
+        1,
+        options.max_following,
+        options.users,
+        POPULARITY.get("following"),
+    )
+    keep = follower != followee
+    return follower[keep], followee[keep]
+
+
+def ratings_shard(options: ShardOptions, lo: int, hi: int):
+    book, user = draw(
+        options.seed,
+        "users.ratings",
+        lo,
+        hi,
+        0,
+        options.max_ratings,
+        options.users,
+        POPULARITY.get("ratings"),
+    )
+    rating = counter_rng.integers(
+        counter_rng.stream(options.seed, "users.ratings", "rating"), book, user, 0, 5
+    )
+    return book, user, rating
+
+
+def sessions_shard(options: ShardOptions, lo: int, hi: int):
+    user, book = draw(
+        options.seed,
+        "users.sessions",
+        lo,
+        hi,
+        0,
+        options.max_sessions,
+        options.editions,
+        POPULARITY.get("sessions"),
+    )
+    key = lambda purpose: counter_rng.stream(options.seed, "users.sessions", purpose)
+    start_dt = counter_rng.integers(
+        key("start"), user, book, 0, options.epoch - options.session_time
+    )
+    end_dt = start_dt + counter_rng.integers(
+        key("length"), user, book, options.session_time // 100, options.session_time
+    )
+    # Page ranges are scaled to each book's length by the caller, which has
+    # the page table
+    return (
+        user,
+        book,
+        start_dt,
+        end_dt,
+        counter_rng.uniform(key("start_page"), user, book),
+        counter_rng.uniform(key("end_page"), user, book),
+    )
+
+
+def shards(
+    context: GeneratorContext,
+    step: str,
+    end: int,
+    description: str,
+    job: Callable,
+    relationship: str,
+    entity: str,
+) -> Iterator[tuple]:
+    """
+    Runs `job` over [start, end) in SUPPLEMENTAL_CHUNK shards and yields the
+    results in shard order, whatever the number of workers.
+    """
+    options = shard_options(context)
+    popularity = relationship_popularity(
+        context,
+        relationship,
+        entity,
+        int(counter_rng.stream(options.seed, relationship, "popularity")),
+    )
+    tables = {relationship: popularity} if popularity is not None else {}
+    set_popularity(tables)
+    start = context.checkpoint.position(step, 0)
+    size = context.options["supplemental_chunk"]
+    ranges = [(lo, min(lo + size, end)) for lo in range(start, end, size)]
+    if context.options["supplemental_workers"] == 1:
+        for lo, hi in track(ranges, description):
+            yield job(options, lo, hi)
+            context.checkpoint.tick(step, hi)
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=context.options["supplemental_workers"],
+        initializer=set_popularity,
+        initargs=(tables,),
+    ) as pool:
+        pending: deque[tuple[Future, int]] = deque()
+        for lo, hi in track(ranges, description):
+            pending.append((pool.submit(job, options, lo, hi), hi))
+            if len(pending) < context.options["supplemental_workers"] * 2:
+                continue
+            future, done = pending.popleft()
+            yield future.result()
+            context.checkpoint.tick(step, done)
+        for future, done in pending:
+            yield future.result()
+            context.checkpoint.tick(step, done)
+
+
+def build_collections(context: GeneratorContext):
+    # Collection names come from the markov chain, which is sequential, so
+    # this one runs serially from a fixed seed instead
+    numpy_engine.build_collections(
+        context,
+        random.Random("{seed}/collections".format(seed=context.options["data_seed"] or 0)),
+    )
+
+
+def make_friends(context: GeneratorContext):
+    following = context.register(
+        "users.following",
+        "INSERT INTO "
+        + context.table("users.following")
+        + " (user_id, following_id) VALUES (:uid, :fid) ON CONFLICT DO NOTHING",
+    )
+    for follower, followee in shards(
+        context,
+        "supplemental.make_friends",
+        context.ids["users"],
+        "\tMaking friends...",
+        follows_shard,
+        "following",
+        "users",
+    ):
+        following.extend(list(zip(follower.tolist(), followee.tolist())))
+    context.clean_cache()
+
+
+def rate_books(context: GeneratorContext):
+    ratings = context.register(
+        "users.ratings",
+        "INSERT INTO "
+        + context.table("users.ratings")
+        + " (book_id, user_id, rating) VALUES (:bid, :uid, :rating) ON CONFLICT DO NOTHING",
+    )
+    for book, user, rating in shards(
+        context,
+        "supplemental.rate_books",
+        context.ids["editions"],
+        "\tRating books...",
+        ratings_shard,
+        "ratings",
+        "users",
+    ):
+        ratings.extend(list(zip(book.tolist(), user.tolist(), rating.tolist())))
+    context.clean_cache()
+
+
+def read_books(context: GeneratorContext):
+    sessions = context.register(
+        "users.sessions",
+        "INSERT INTO "
+        + context.table("users.sessions")
+        + " (session_id, book_id, user_id, start_datetime, end_datetime, start_page, end_page) VALUES (:sid, :bid, :uid, :sdt, :edt, :sp, :ep) ON CONFLICT DO NOTHING",
+    )
+    pages = np.frombuffer(context.atomics.pages.pages, dtype=np.uint64)
+    for user, book, start_dt, end_dt, start_u, end_u in shards(
+        context,
+        "supplemental.read_books",
+        context.ids["users"],
+        "\tAcquiring an education...",
+        sessions_shard,
+        "sessions",
+        "editions",
+    ):
+        count = len(user)
+        if count == 0:
+            continue
+        length = pages[book].astype(np.int64)
+        start_page = (start_u * (length + 1)).astype(np.int64)
+        end_page = start_page + (end_u * (length - start_page + 1)).astype(np.int64)
+        # IDs are handed out in shard order, so they don't depend on workers
+        ids = np.arange(count) + context.id_range("sessions", count)
+        sessions.extend(
+            list(
+                zip(
+                    ids.tolist(),
+                    book.tolist(),
+                    user.tolist(),
+                    map(datetime.datetime.fromtimestamp, start_dt.tolist()),
+                    map(datetime.datetime.fromtimestamp, end_dt.tolist()),
+                    start_page.tolist(),
+                    end_page.tolist(),
+                )
+            )
+        )
+    context.clean_cache()
@@ -1,7 +1,13 @@
 from util import GeneratorContext
+from loaders import column_type
 import json
+import re
 from typing_extensions import TypedDict
+from rich import print
 from rich.progress import Progress
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+UNIQUE_PATTERN = re.compile(r"\s+unique\b", re.IGNORECASE)
 
 class TableSpec(TypedDict):
     name: str
@@ -9,14 +15,31 @@ class TableSpec(TypedDict):
     columns: list[str]
     primary: list[str]
 
-def tables_main(context: GeneratorContext):
+def load_spec(context: GeneratorContext) -> list[TableSpec]:
     with open(context.options["db_tables"], "r") as tablespec:
-        spec: list[TableSpec] = json.load(tablespec)
-    
+        return json.load(tablespec)
+
+def load_tables(context: GeneratorContext, spec: list[TableSpec]):
+    # Table names and column types, without touching the database
     for t in spec:
         context.tables[t["refer"]] = t["name"]
+        context.columns[t["name"]] = {
+            c.split(" ")[0]: column_type(c) for c in t["columns"]
+        }
+
+def tables_main(context: GeneratorContext):
+    spec = load_spec(context)
+    load_tables(context, spec)
+
+    creating = "tables" in context.options["steps"] and not context.checkpoint.done("tables")
+    # Only tables created under the load profile lack keys: by this run, or by
+    # the run being resumed if it never got to finalize_tables. Tables that
+    # already existed are assumed to be keyed.
+    if context.options["table_profile"] == "load" and not context.checkpoint.done("finalize_tables"):
+        if creating or context.checkpoint.done("tables"):
+            context.unkeyed.update([t["name"] for t in spec])
 
-    if "tables" in context.options["steps"]:
+    if creating:
         with Progress() as progress:
             progress.console.print("[green][bold]STEP: [/bold] Generating tables...[/green]")
             tables_task = progress.add_task("\tCreating tables...", total=len(spec))
@@ -25,16 +48,79 @@ def tables_main(context: GeneratorContext):
                 progress.update(tables_task, advance=1)
                 progress.console.print(f"\t[grey70 italic]Generated {table['refer']} ({table['name']})[/grey70 italic]")
             
-            context.db.commit()
+            context.commit()
+        context.checkpoint.complete("tables")
 
 def create_table(context: GeneratorContext, table: TableSpec):
     if context.options["db_clear"]:
         remove_table(context, table["name"])
-    context.db.execute("CREATE TABLE {name} ({columns}, PRIMARY KEY ({primary}))".format(
+    if context.options["table_profile"] == "load":
+        # Keys are added by finalize_tables once all data is in
+        context.execute("CREATE UNLOGGED TABLE {name} ({columns})".format(
+            name=table["name"],
+            columns=", ".join([UNIQUE_PATTERN.sub("", c) for c in table["columns"]])
+        ))
+        return
+    context.execute("CREATE TABLE {name} ({columns}, PRIMARY KEY ({primary}))".format(
         name=table["name"],
         columns=", ".join(table["columns"]),
         primary=", ".join(table["primary"])
     ))
 
 def remove_table(context: GeneratorContext, table: str):
-    context.db.execute(f"DROP TABLE IF EXISTS {table};")
\ No newline at end of file
+    context.execute(f"DROP TABLE IF EXISTS {table};")
+
+def unique_columns(table: TableSpec) -> list[str]:
+    return [c.split(" ")[0] for c in table["columns"] if UNIQUE_PATTERN.search(c)]
+
+def finalize_statements(context: GeneratorContext, table: TableSpec) -> list[str]:
+    name = table["name"]
+    keys = [table["primary"]] + [[c] for c in unique_columns(table)]
+    statements = [f"SET maintenance_work_mem = '{context.options['load_maintenance_mem']}'"]
+    for key in keys:
+        # Keep the first row of each key, same as ON CONFLICT DO NOTHING would have
+        statements.append(
+            "DELETE FROM {name} WHERE ctid IN (SELECT ctid FROM (SELECT ctid, row_number() OVER (PARTITION BY {key} ORDER BY ctid) AS n FROM {name}) AS numbered WHERE n > 1)".format(
+                name=name, key=", ".join(key)
+            )
+        )
+    statements.append(f"ALTER TABLE {name} ADD PRIMARY KEY ({', '.join(table['primary'])})")
+    for column in unique_columns(table):
+        statements.append(f"ALTER TABLE {name} ADD UNIQUE ({column})")
+    statements.append(f"ANALYZE {name}")
+    statements.append(f"ALTER TABLE {name} SET LOGGED")
+    return statements
+
+def finalize_table(context: GeneratorContext, table: TableSpec) -> TableSpec:
+    conn = context._connect()
+    for statement in finalize_statements(context, table):
+        conn.execute(statement)
+    conn.commit()
+    conn.close()
+    return table
+
+def finalize_tables(context: GeneratorContext):
+    if context.options["table_profile"] != "load" or context.checkpoint.done("finalize_tables"):
+        return
+    spec = [t for t in load_spec(context) if t["name"] in context.unkeyed]
+    if len(spec) == 0:
+        return
+    context.clean_cache()
+    context.commit()
+
+    print("[green][bold]STEP: [/bold] Finalizing tables...[/green]")
+    if context.db is None:
+        # File sink: each table's statements run in one psql session
+        for table in spec:
+            context.execute("; ".join(finalize_statements(context, table)))
+    else:
+        # One connection per table, so index builds run in parallel
+        with Progress() as progress, ThreadPoolExecutor(max_workers=context.options["load_workers"]) as pool:
+            task = progress.add_task("\tBuilding keys...", total=len(spec))
+            for future in as_completed([pool.submit(finalize_table, context, t) for t in spec]):
+                table = future.result()
+                progress.update(task, advance=1)
+                progress.console.print(f"\t[grey70 italic]Finalized {table['refer']} ({table['name']})[/grey70 italic]")
+
+    context.unkeyed.clear()
+    context.checkpoint.complete("finalize_tables")
@@ -1,11 +1,22 @@
 from dotenv import load_dotenv
 from os import getenv, environ
 from typing_extensions import TypedDict
-from typing import Union, Literal, Any
+from typing import Union, Literal, Any, Callable
 from sshtunnel import SSHTunnelForwarder
 import psycopg
+import asyncio
+import time
 import re
+import random
 from markov_word_generator import MarkovWordGenerator
+from markov import MarkovCache, BatchMarkov
+from loaders import Statement, parse_insert, make_loader
+from checkpoint import Checkpoint
+from atomics import Atomics
+from resolver import AuthorResolver
+from writers import SyncWriter, BackgroundWriter, WriterPool, AsyncWriter
+from sink import FileSink
+from metrics import Metrics
 
 
 class OptionsDict(TypedDict):
@@ -22,14 +33,44 @@ class OptionsDict(TypedDict):
     db_tunnel_password: str
     db_clear: bool
     db_tables: str
+    db_loader: str
+    db_copy_format: str
+    db_writer: str
+    writer_queue: int
+    db_pipeline: bool
+    pipeline_depth: int
+    db_pool_size: int
+    db_pool_partition: list[str]
+    db_prepare: bool
+    sink: str
+    sink_path: str
+    sink_format: str
+    sink_compression: str
+    sink_chunk_rows: int
+    table_profile: str
+    load_workers: int
+    load_maintenance_mem: str
+    metrics_path: str
     data_path: str
     data_limit: Union[int, None]
+    author_resolver: str
+    resolver_budget: int
+    resolver_spill: str
+    data_sample: str
+    data_seed: Union[int, None]
+    data_index: str
+    data_workers: int
+    data_chunk: int
+    date_cache_size: int
+    json_decoder: str
     user_count: int
     max_password: int
     max_name: int
     max_email: int
     names_dict: str
     words_dict: str
+    markov_cache: str
+    markov_engine: Literal["python", "numpy"]
     max_ratings: int
     max_collections: int
     max_collection_size: int
@@ -39,9 +80,21 @@ class OptionsDict(TypedDict):
     max_following: int
     audiences: list[str]
     max_audiences: int
+    supplemental_engine: Literal["python", "numpy", "sharded"]
+    supplemental_chunk: int
+    supplemental_workers: int
+    supplemental_epoch: Union[int, None]
+    popularity_following: str
+    popularity_ratings: str
+    popularity_sessions: str
+    popularity_collections: str
     rand_start: int
     rand_end: int
     rand_count: int
+    rand_chunk: int
+    checkpoint_path: str
+    checkpoint_interval: int
+    resume: bool
 
 
 REFERENCE_NAMES = Literal[
@@ -66,10 +119,34 @@ REFERENCE_NAMES = Literal[
 CACHE_SIZE = 5000
 
 
+class CachedStatement:
+    """
+    Registered INSERT and its pending rows. add() takes the values in the
+    order their :placeholders appear in the query.
+    """
+
+    def __init__(self, statement: Statement, flush: Callable[["CachedStatement"], None]):
+        self.statement = statement
+        self.rows: list[tuple] = []
+        self.flush = flush
+
+    def add(self, *values: Any):
+        self.rows.append(values)
+        if len(self.rows) > CACHE_SIZE:
+            self.flush(self)
+
+    def extend(self, rows: list[tuple]):
+        self.rows.extend(rows)
+        if len(self.rows) > CACHE_SIZE:
+            self.flush(self)
+
+
 class GeneratorContext:
     def __init__(self):
         load_dotenv()
         self.tables: dict[str, str] = {}
+        self.columns: dict[str, dict[str, str]] = {}
+        self.unkeyed: set[str] = set()
         self.book_count: int = 0
         self.options: OptionsDict = {
             "steps": getenv(
@@ -87,14 +164,46 @@ class GeneratorContext:
             "db_tunnel_password": getenv("DB_TUNNEL_PASSWORD", None),
             "db_clear": getenv("DB_CLEAR", "true") == "true",
             "db_tables": environ["DB_TABLES"],
+            "db_loader": getenv("DB_LOADER", "copy"),
+            "db_copy_format": getenv("DB_COPY_FORMAT", "binary"),
+            "db_writer": getenv("DB_WRITER", "thread"),
+            "writer_queue": int(getenv("WRITER_QUEUE", "4")),
+            "db_pipeline": getenv("DB_PIPELINE", "false") == "true",
+            "pipeline_depth": int(getenv("PIPELINE_DEPTH", "8")),
+            "db_pool_size": int(getenv("DB_POOL_SIZE", "1")),
+            "db_pool_partition": getenv(
+                "DB_POOL_PARTITION", "users.sessions users.ratings"
+            ).split(" "),
+            "db_prepare": getenv("DB_PREPARE", "true") == "true",
+            "sink": getenv("SINK", "db"),
+            "sink_path": getenv("SINK_PATH", "output"),
+            "sink_format": getenv("SINK_FORMAT", "binary"),
+            "sink_compression": getenv("SINK_COMPRESSION", "none"),
+            "sink_chunk_rows": int(getenv("SINK_CHUNK_ROWS", "1000000")),
+            "table_profile": getenv("TABLE_PROFILE", "default"),
+            "load_workers": int(getenv("LOAD_WORKERS", "4")),
+            "load_maintenance_mem": getenv("LOAD_MAINTENANCE_MEM", "1GB"),
+            "metrics_path": getenv("METRICS_PATH", "datagen.metrics.jsonl"),
             "data_path": environ["DATA_PATH"],
             "data_limit": int(environ["DATA_LIMIT"]) if getenv("DATA_LIMIT") else None,
+            "author_resolver": getenv("AUTHOR_RESOLVER", "memory"),
+            "resolver_budget": int(getenv("RESOLVER_BUDGET", "10000000")),
+            "resolver_spill": getenv("RESOLVER_SPILL", "authors.spill"),
+            "data_sample": getenv("DATA_SAMPLE", "first"),
+            "data_seed": int(environ["DATA_SEED"]) if getenv("DATA_SEED") else None,
+            "data_index": getenv("DATA_INDEX", environ["DATA_PATH"] + ".idx"),
+            "data_workers": int(getenv("DATA_WORKERS", "1")),
+            "data_chunk": int(getenv("DATA_CHUNK", str(16 * 1024 * 1024))),
+            "date_cache_size": int(getenv("DATE_CACHE_SIZE", "65536")),
+            "json_decoder": getenv("JSON_DECODER", "json"),
             "user_count": int(getenv("USER_COUNT", "500")),
             "max_password": int(getenv("MAX_PASSWORD", "50")),
             "max_name": int(getenv("MAX_NAME", "25")),
             "max_email": int(getenv("MAX_EMAIL", "50")),
             "names_dict": environ["NAMES_DICT"],
             "words_dict": environ["WORDS_DICT"],
+            "markov_cache": getenv("MARKOV_CACHE", ".markov"),
+            "markov_engine": getenv("MARKOV_ENGINE", "python"),
             "max_ratings": int(getenv("MAX_RATINGS", "100")),
             "max_collections": int(getenv("MAX_COLLECTIONS", "10")),
             "max_collection_name": int(getenv("MAX_COLLECTION_NAME", "50")),
@@ -104,16 +213,72 @@ class GeneratorContext:
             "max_following": int(getenv("MAX_FOLLOWING", "100")),
             "audiences": [i.strip() for i in getenv("AUDIENCES", "").split(",")],
             "max_audiences": int(getenv("MAX_AUDIENCES", "3")),
+            "supplemental_engine": getenv("SUPPLEMENTAL_ENGINE", "python"),
+            "supplemental_chunk": int(getenv("SUPPLEMENTAL_CHUNK", "10000")),
+            "supplemental_workers": int(getenv("SUPPLEMENTAL_WORKERS", "1")),
+            "supplemental_epoch": int(environ["SUPPLEMENTAL_EPOCH"])
+            if getenv("SUPPLEMENTAL_EPOCH")
+            else None,
+            "popularity_following": getenv("POPULARITY_FOLLOWING", "uniform"),
+            "popularity_ratings": getenv("POPULARITY_RATINGS", "uniform"),
+            "popularity_sessions": getenv("POPULARITY_SESSIONS", "uniform"),
+            "popularity_collections": getenv("POPULARITY_COLLECTIONS", "uniform"),
             "rand_start": int(environ["START_DELTA"]),
             "rand_end": int(environ["END_DELTA"]),
             "rand_count": int(environ["GENERATE"]),
+            "rand_chunk": int(getenv("GENERATE_CHUNK", "10000")),
+            "checkpoint_path": getenv("CHECKPOINT_PATH", "datagen.checkpoint"),
+            "checkpoint_interval": int(getenv("CHECKPOINT_INTERVAL", "300")),
+            "resume": getenv("RESUME", "false") == "true",
         }
-        self.db = self._open_database()
+        self.metrics = Metrics(self.options["metrics_path"])
         self.ids: dict[str, int] = {}
-        self.exec_cache: dict[str, list[dict]] = {}
-        self.atomics = {"genre": {}, "publisher": {}, "pages": {}}
+        self.statements: dict[str, CachedStatement] = {}
+        self.loader = make_loader(
+            self.options["db_loader"],
+            self.columns,
+            self.options["db_copy_format"],
+            self.unkeyed,
+        )
+        self.atomics = Atomics()
+        self.markov = MarkovCache(self.options["markov_cache"])
+        self.resolver = (
+            AuthorResolver(
+                self.options["resolver_budget"], self.options["resolver_spill"]
+            )
+            if self.options["author_resolver"] == "memory"
+            else None
+        )
+        if self.options["rand_chunk"] < 1:
+            raise ValueError("GENERATE_CHUNK must be at least 1")
+        self.checkpoint = Checkpoint(
+            self,
+            self.options["checkpoint_path"],
+            self.options["checkpoint_interval"],
+            self.options["resume"],
+        )
+        if self.options["sink"] == "files" and self.checkpoint.resumed:
+            raise ValueError("RESUME isn't supported with SINK = files")
+        self.db = self._open_database()
+        self.writer = self._open_writer()
+        if "staging" in self.options["steps"] and not self.checkpoint.resumed:
+            self._create_staging()
+        if "staging" in self.options["steps"]:
+            self.register(
+                "staging.mapping",
+                "INSERT INTO staging_id_mapping (original, mapped) VALUES (:original, :mapped)",
+            )
+            self.register(
+                "staging.authors",
+                "INSERT INTO staging_books_authors_mapping (book_id, author_raw) VALUES (:book, :author) ON CONFLICT DO NOTHING",
+            )
 
-    def _open_database(self) -> psycopg.Connection:
+    def _open_database(self) -> Union[psycopg.Connection, None]:
+        if self.options["sink"] == "files":
+            self.tunnel = None
+            return None
+        if self.options["sink"] != "db":
+            raise ValueError("Unknown SINK: " + self.options["sink"])
         if self.options["db_tunnel"]:
             self.tunnel = SSHTunnelForwarder(
                 (self.options["db_tunnel_addr"], self.options["db_tunnel_port"]),
@@ -122,47 +287,107 @@ class GeneratorContext:
                 remote_bind_address=(self.options["db_ip"], self.options["db_port"]),
             )
             self.tunnel.start()
-            conn = psycopg.connect(
-                **{
-                    "dbname": self.options["db_database"],
-                    "user": self.options["db_user"],
-                    "password": self.options["db_password"],
-                    "host": self.tunnel.local_bind_host,
-                    "port": self.tunnel.local_bind_port,
-                }
-            )
+            self.db_address = (self.tunnel.local_bind_host, self.tunnel.local_bind_port)
         else:
             self.tunnel = None
-            conn = psycopg.connect(
-                **{
-                    "dbname": self.options["db_database"],
-                    "user": self.options["db_user"],
-                    "password": self.options["db_password"],
-                    "host": self.options["db_ip"],
-                    "port": self.options["db_port"],
-                }
+            self.db_address = (self.options["db_ip"], self.options["db_port"])
+        return self._connect()
+
+    def _create_staging(self):
+        self.execute("DROP TABLE IF EXISTS staging_id_mapping;")
+        self.execute(
+            "CREATE TABLE staging_id_mapping (original varchar(100) not null, mapped int not null, primary key (original, mapped));"
+        )
+        self.execute("DROP TABLE IF EXISTS staging_books_authors_mapping;")
+        self.execute(
+            "CREATE TABLE staging_books_authors_mapping (book_id int not null, author_raw text not null, primary key (book_id, author_raw));"
+        )
+        self.commit()
+
+    def _open_writer(
+        self,
+    ) -> Union[SyncWriter, BackgroundWriter, WriterPool, AsyncWriter, FileSink]:
+        if self.options["sink"] == "files":
+            return FileSink(
+                self.options["sink_path"],
+                self.columns,
+                self.options["sink_format"] == "binary",
+                self.options["sink_compression"],
+                self.options["sink_chunk_rows"],
+                self.metrics,
+                self.unkeyed,
             )
-        if "staging" in self.options["steps"]:
-            conn.execute("DROP TABLE IF EXISTS staging_id_mapping;")
-            conn.execute(
-                "CREATE TABLE staging_id_mapping (original varchar(100) not null, mapped int not null, primary key (original, mapped));"
+        if self.options["db_writer"] != "thread":
+            return SyncWriter(
+                self.db,
+                self.loader,
+                self.options["db_pipeline"],
+                self.options["pipeline_depth"],
+                self.metrics,
             )
-            conn.execute("DROP TABLE IF EXISTS staging_books_authors_mapping;")
-            conn.execute(
-                "CREATE TABLE staging_books_authors_mapping (book_id int not null, author_raw text not null, primary key (book_id, author_raw));"
+        if self.options["db_pool_size"] > 1:
+            return WriterPool(
+                self._connect,
+                self.loader,
+                self.options["db_pool_size"],
+                self.options["writer_queue"],
+                self.options["db_pipeline"],
+                self.options["pipeline_depth"],
+                self._partitioned,
+                self.metrics,
             )
-            conn.commit()
-        return conn
+        return BackgroundWriter(
+            self._connect,
+            self.loader,
+            self.options["writer_queue"],
+            self.options["db_pipeline"],
+            self.options["pipeline_depth"],
+            self.metrics,
+        )
+
+    def _partitioned(self, table: str) -> bool:
+        return table in [
+            self.tables.get(ref) for ref in self.options["db_pool_partition"]
+        ]
+
+    def _connect_args(self) -> dict[str, Any]:
+        return {
+            "dbname": self.options["db_database"],
+            "user": self.options["db_user"],
+            "password": self.options["db_password"],
+            "host": self.db_address[0],
+            "port": self.db_address[1],
+            # Cached INSERTs run many times per connection, prepare them right away
+            "prepare_threshold": 0 if self.options["db_prepare"] else None,
+        }
+
+    def _connect(self) -> psycopg.Connection:
+        return psycopg.connect(**self._connect_args())
+
+    def execute(self, query: str):
+        if self.db is None:
+            # Rows cached so far have to load before this statement runs
+            self.clean_cache()
+            self.writer.execute(query)
+        else:
+            self.db.execute(query)
+
+    def commit(self):
+        if self.db:
+            self.db.commit()
 
     def cleanup(self):
         self.clean_cache()
         if "clear_staging" in self.options["steps"]:
-            self.db.execute("DROP TABLE staging_id_mapping;")
-            self.db.execute("DROP TABLE staging_books_authors_mapping;")
-        self.db.commit()
-        self.db.close()
+            self.execute("DROP TABLE staging_id_mapping;")
+            self.execute("DROP TABLE staging_books_authors_mapping;")
+        self.writer.close()
+        if self.db:
+            self.db.commit()
+            self.db.close()
         if self.tunnel:
             self.tunnel.stop()
+        self.metrics.report(self.options)
 
     def id(self, entity: str) -> int:
         if not entity in self.ids.keys():
@@ -171,57 +396,96 @@ class GeneratorContext:
         self.ids[entity] += 1
         return self.ids[entity]
 
+    def id_range(self, entity: str, count: int) -> int:
+        # First of `count` consecutive IDs, same as calling id() `count` times
+        first = self.id(entity)
+        self.ids[entity] += count - 1
+        return first
+
     def create_mapped(self, entity_type: str, original_id: str, mapped_id: int):
         if not "staging" in self.options["steps"]:
             return
-        self.execute_cached(
-            "INSERT INTO staging_id_mapping (original, mapped) VALUES (:original, :mapped)",
-            dict(original=original_id, mapped=mapped_id),
-        )
+        self.statements["staging.mapping"].add(original_id, mapped_id)
 
     def table(self, ref: REFERENCE_NAMES) -> str:
         return self.tables[ref]
 
+    def register(self, name: str, query: str) -> CachedStatement:
+        """
+        Parses `query` (named :placeholders) once and returns the handle
+        rows are added through, also kept as self.statements[name].
+        Registering a name again returns the existing handle.
+        """
+        if not name in self.statements.keys():
+            self.statements[name] = CachedStatement(parse_insert(query), self._flush)
+        return self.statements[name]
+
     def execute_cached(self, query: str, params: dict[str, Any]):
-        for p in params.keys():
-            query = query.replace(":" + p, "%(" + p + ")s")
-        if not query in self.exec_cache.keys():
-            self.exec_cache[query] = []
-
-        self.exec_cache[query].append(params)
-        if len(self.exec_cache[query]) > CACHE_SIZE:
-            try:
-                cursor = self.db.cursor()
-                cursor.executemany(query, self.exec_cache[query])
-                self.db.commit()
-            except SystemExit:
-                print("CACHE ERROR")
-            del self.exec_cache[query]
+        handle = self.register(query, query)
+        handle.add(*[params[p] for p in handle.statement.params])
+
+    def _flush(self, handle: CachedStatement):
+        if len(handle.rows) == 0:
+            return
+        # The full buffer is handed to the writer, new rows go into a fresh one
+        started = time.perf_counter()
+        self.writer.submit(handle.statement, handle.rows)
+        self.metrics.wait(time.perf_counter() - started)
+        handle.rows = []
 
     def clean_cache(self):
-        for query, params in self.exec_cache.items():
-            try:
-                cursor = self.db.cursor()
-                cursor.executemany(query, params)
-                self.db.commit()
-            except SystemExit:
-                print("CACHE ERROR")
-        self.exec_cache = {}
+        for handle in self.statements.values():
+            self._flush(handle)
+        started = time.perf_counter()
+        self.writer.drain()
+        self.metrics.wait(time.perf_counter() - started)
 
     def stage_author(self, book: int, author: str):
         if not "staging" in self.options["steps"]:
             return
-        self.execute_cached(
-            "INSERT INTO staging_books_authors_mapping (book_id, author_raw) VALUES (:book, :author) ON CONFLICT DO NOTHING",
-            {"book": book, "author": author},
-        )
+        self.statements["staging.authors"].add(book, author)
 
     def get_markov(
-        self, type: Literal["names", "words"], length: int
-    ) -> MarkovWordGenerator:
-        return MarkovWordGenerator(
-            length,
-            self.options["names_dict"]
-            if type == "names"
-            else self.options["words_dict"],
+        self,
+        type: Literal["names", "words"],
+        length: int,
+        source: Union[random.Random, None] = None,
+    ) -> Union[MarkovWordGenerator, BatchMarkov]:
+        # `source` only seeds the numpy engine, the python one always draws
+        # from the global `random`
+        dictionary = (
+            self.options["names_dict"] if type == "names" else self.options["words_dict"]
+        )
+        if self.options["markov_engine"] == "numpy":
+            return self.markov.batch(
+                dictionary, length, (source or random).getrandbits(64)
+            )
+        return self.markov.get(dictionary, length)
+
+
+class AsyncGeneratorContext(GeneratorContext):
+    """
+    GeneratorContext whose cached batches are flushed by coroutines on
+    `loop` over a psycopg.AsyncConnection. Must be created and used from a
+    thread other than the loop's, see main.async_main.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        super().__init__()
+
+    def _open_writer(self) -> Union[AsyncWriter, FileSink]:
+        if self.options["sink"] == "files":
+            return super()._open_writer()
+        return AsyncWriter(
+            self.loop,
+            self._connect_async,
+            self.loader,
+            self.options["writer_queue"],
+            self.options["db_pipeline"],
+            self.options["pipeline_depth"],
+            self.metrics,
         )
+
+    async def _connect_async(self) -> psycopg.AsyncConnection:
+        return await psycopg.AsyncConnection.connect(**self._connect_args())
@@ -0,0 +1,314 @@
+from typing import Awaitable, Callable, Union
+from queue import Queue, Empty, Full
+from threading import Thread
+from loaders import (
+    Statement,
+    InsertLoader,
+    CopyLoader,
+    flush_batches,
+    flush_batches_async,
+)
+from metrics import Metrics
+import asyncio
+import psycopg
+import time
+
+Loader = Union[InsertLoader, CopyLoader]
+
+
+class WriterError(RuntimeError):
+    pass
+
+
+class SyncWriter:
+    """
+    Flushes on the caller's connection. In pipeline mode up to `depth`
+    batches are collected and sent in one pipeline before committing.
+    """
+
+    def __init__(
+        self,
+        db: psycopg.Connection,
+        loader: Loader,
+        pipeline: bool,
+        depth: int,
+        metrics: Metrics,
+    ):
+        self.db = db
+        self.loader = loader
+        self.metrics = metrics
+        self.pipeline = pipeline
+        self.depth = depth if pipeline else 1
+        self.pending: list[tuple[Statement, list[tuple]]] = []
+
+    def submit(self, statement: Statement, rows: list[tuple]):
+        self.pending.append((statement, rows))
+        if len(self.pending) >= self.depth:
+            self.drain()
+
+    def drain(self):
+        if len(self.pending) == 0:
+            return
+        try:
+            started = time.perf_counter()
+            flush_batches(self.db, self.loader, self.pending, self.pipeline)
+            self.metrics.flush(self.pending, time.perf_counter() - started)
+        except SystemExit:
+            print("CACHE ERROR")
+        self.pending = []
+
+    def close(self):
+        pass
+
+
+class BackgroundWriter:
+    """
+    Flushes batches on a dedicated thread with its own connection, so the
+    producer can keep generating rows. submit() blocks while `queue_size`
+    batches are already waiting. The first failed batch stops the writer and
+    is raised from the next submit() or drain(), as is the thread dying.
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], psycopg.Connection],
+        loader: Loader,
+        queue_size: int,
+        pipeline: bool,
+        depth: int,
+        metrics: Metrics,
+    ):
+        self.db = connect()
+        self.loader = loader
+        self.metrics = metrics
+        self.pipeline = pipeline
+        self.depth = depth if pipeline else 1
+        self.queue: Queue[Union[tuple[Statement, list[tuple]], None]] = Queue(
+            maxsize=queue_size
+        )
+        self.error: Union[WriterError, None] = None
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, statement: Statement, rows: list[tuple]):
+        # Timed waits, so a writer thread that died can't block us forever
+        while True:
+            self._raise()
+            try:
+                self.queue.put((statement, rows), timeout=0.1)
+                return
+            except Full:
+                continue
+
+    def drain(self):
+        self._join()
+        self._raise()
+
+    def close(self):
+        self.drain()
+        self.queue.put(None)
+        self.thread.join()
+        self.db.close()
+
+    def _join(self):
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks and self.thread.is_alive():
+                self.queue.all_tasks_done.wait(0.1)
+
+    def _raise(self):
+        if self.error:
+            raise self.error
+        if not self.thread.is_alive():
+            raise WriterError("Background writer stopped unexpectedly")
+
+    def _run(self):
+        while True:
+            batches = [self.queue.get()]
+            # In pipeline mode, take whatever else is already waiting
+            while len(batches) < self.depth and batches[-1] is not None:
+                try:
+                    batches.append(self.queue.get_nowait())
+                except Empty:
+                    break
+
+            stop = batches[-1] is None
+            if stop:
+                batches.pop()
+            try:
+                # Once a batch failed, the rest are dropped until it's reported
+                if not self.error and len(batches) > 0:
+                    started = time.perf_counter()
+                    flush_batches(self.db, self.loader, batches, self.pipeline)
+                    self.metrics.flush(batches, time.perf_counter() - started)
+            except Exception as e:
+                self.error = WriterError(str(e))
+                self.error.__cause__ = e
+                try:
+                    self.db.rollback()
+                except Exception:
+                    # The original error is the one worth reporting
+                    pass
+            finally:
+                for _ in range(len(batches) + (1 if stop else 0)):
+                    self.queue.task_done()
+            if stop:
+                return
+
+
+class WriterPool:
+    """
+    Spreads batches over `size` background writers, each with its own
+    connection. Every table is pinned to one writer so its batches stay in
+    order, tables for which `partitioned` is true are hash-split on their
+    first column instead. drain() waits for all writers, so anything run
+    after clean_cache() (link_books JOINs, trims) sees every row.
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], psycopg.Connection],
+        loader: Loader,
+        size: int,
+        queue_size: int,
+        pipeline: bool,
+        depth: int,
+        partitioned: Callable[[str], bool],
+        metrics: Metrics,
+    ):
+        self.writers = [
+            BackgroundWriter(connect, loader, queue_size, pipeline, depth, metrics)
+            for _ in range(size)
+        ]
+        self.partitioned = partitioned
+        self.routes: dict[str, BackgroundWriter] = {}
+
+    def submit(self, statement: Statement, rows: list[tuple]):
+        if self.partitioned(statement.table):
+            parts: list[list[tuple]] = [[] for _ in self.writers]
+            for row in rows:
+                parts[hash(row[0]) % len(parts)].append(row)
+            for writer, part in zip(self.writers, parts):
+                if len(part) > 0:
+                    writer.submit(statement, part)
+            return
+
+        if not statement.table in self.routes.keys():
+            self.routes[statement.table] = self.writers[
+                len(self.routes) % len(self.writers)
+            ]
+        self.routes[statement.table].submit(statement, rows)
+
+    def drain(self):
+        for writer in self.writers:
+            writer._join()
+        for writer in self.writers:
+            writer._raise()
+
+    def close(self):
+        self.drain()
+        for writer in self.writers:
+            writer.close()
+
+
+class AsyncWriter:
+    """
+    Flushes batches from a task on an asyncio event loop, over a
+    psycopg.AsyncConnection. Steps run in a worker thread (asyncio.to_thread)
+    and hand their batches to the loop, so generation continues while the
+    loop waits on the database. Only the calling thread ever blocks, never
+    the loop.
+    """
+
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        connect: Callable[[], Awaitable[psycopg.AsyncConnection]],
+        loader: Loader,
+        queue_size: int,
+        pipeline: bool,
+        depth: int,
+        metrics: Metrics,
+    ):
+        self.loop = loop
+        self.loader = loader
+        self.metrics = metrics
+        self.pipeline = pipeline
+        self.depth = depth if pipeline else 1
+        self.error: Union[WriterError, None] = None
+        self._call(self._start(connect, queue_size))
+
+    def submit(self, statement: Statement, rows: list[tuple]):
+        self._raise()
+        self._call(self._unless_stopped(self.queue.put((statement, rows))))
+
+    def drain(self):
+        self._call(self._unless_stopped(self.queue.join()))
+        self._raise()
+
+    def close(self):
+        self.drain()
+        self._call(self._stop())
+
+    def _call(self, coroutine: Awaitable):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def _raise(self):
+        if self.error:
+            raise self.error
+        if self.task.done():
+            raise WriterError("Async writer stopped unexpectedly")
+
+    async def _unless_stopped(self, coroutine: Awaitable):
+        # Gives up once the writer task is gone, nothing would wake us up
+        waiter = asyncio.ensure_future(coroutine)
+        await asyncio.wait([waiter, self.task], return_when=asyncio.FIRST_COMPLETED)
+        if not waiter.done():
+            waiter.cancel()
+
+    async def _start(
+        self,
+        connect: Callable[[], Awaitable[psycopg.AsyncConnection]],
+        queue_size: int,
+    ):
+        self.db = await connect()
+        self.queue: asyncio.Queue[
+            Union[tuple[Statement, list[tuple]], None]
+        ] = asyncio.Queue(maxsize=queue_size)
+        self.task = asyncio.create_task(self._run())
+
+    async def _stop(self):
+        await self.queue.put(None)
+        await self.task
+        await self.db.close()
+
+    async def _run(self):
+        while True:
+            batches = [await self.queue.get()]
+            while len(batches) < self.depth and batches[-1] is not None:
+                try:
+                    batches.append(self.queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+
+            stop = batches[-1] is None
+            if stop:
+                batches.pop()
+            try:
+                if not self.error and len(batches) > 0:
+                    started = time.perf_counter()
+                    await flush_batches_async(
+                        self.db, self.loader, batches, self.pipeline
+                    )
+                    self.metrics.flush(batches, time.perf_counter() - started)
+            except Exception as e:
+                self.error = WriterError(str(e))
+                self.error.__cause__ = e
+                try:
+                    await self.db.rollback()
+                except Exception:
+                    pass
+            finally:
+                for _ in range(len(batches) + (1 if stop else 0)):
+                    self.queue.task_done()
+            if stop:
+                return